@@ -4,6 +4,7 @@ from django import forms
 from datetime import date, datetime, timedelta
 from django.forms import inlineformset_factory
 from .models import FakturaStavka, Klijenti, Dokumenti, DEF_OPT, OtpremnicaStavka, UlaznaFakturaStavka
+from .utils.services import STAVKE_MODELS
 
 
 class ClientForm(forms.ModelForm):
@@ -281,19 +282,25 @@ class DokumentStavkeForm(forms.ModelForm):
         #     else:
         #         self.initial['kolicina'] = round(kolicina, 2)    
     
-def get_stavke_formset(tip):
+# extra empty rows per view mode: one to start typing into on create, none on edit
+STAVKE_FORMSET_EXTRA = {"create": 1, "edit": 0}
 
-    model = {
-        "IZF": FakturaStavka,
-        "OTP": OtpremnicaStavka,
-        "ULF": UlaznaFakturaStavka,
-    }[tip]
-
-    return inlineformset_factory(
+# inlineformset_factory builds a form and a formset class on every call; the
+# classes hold no per-request state, so build them once per (dok_tip, mode)
+STAVKE_FORMSETS = {
+    (tip, mode): inlineformset_factory(
         Dokumenti,
         model,
         form=DokumentStavkeForm,
+        fk_name=fk_name,
         fields=["tip_prometa", "naziv", "kolicina", "jed_mere", "cena"],
-        extra=1,
+        extra=extra,
         can_delete=True,
-    )
\ No newline at end of file
+    )
+    for tip, (model, fk_name) in STAVKE_MODELS.items()
+    for mode, extra in STAVKE_FORMSET_EXTRA.items()
+}
+
+def get_stavke_formset(tip, mode="create"):
+    """The prebuilt item formset class for `tip`, or None for an unknown type."""
+    return STAVKE_FORMSETS.get((tip, mode))
@@ -0,0 +1,164 @@
+import os
+import random
+import statistics
+import tempfile
+import time
+from datetime import date, timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connections
+from django.db.models import Sum
+
+from gtbook.models import Dokumenti, Klijenti, Mesto
+
+ALIAS = "benchmark"
+# indexes added for the hot Dokumenti filters (migration 0037)
+INDEX_NAMES = (
+    "idx_dokumenti_tip_datum",
+    "idx_dokumenti_sales_id",
+    "idx_dokumenti_purchase_id",
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Seed a throwaway SQLite database and compare query plans and timings "
+        "of the hot Dokumenti filters without and with the composite indexes"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--documents", type=int, default=100_000)
+        parser.add_argument("--clients", type=int, default=500)
+        parser.add_argument("--repeat", type=int, default=20, help="Runs per query (median is shown)")
+
+    def handle(self, *args, **options):
+        fd, path = tempfile.mkstemp(prefix="gtbook-bench-", suffix=".sqlite3")
+        os.close(fd)
+        # configure_settings() fills in the defaults but insists on a "default" key
+        connections.settings[ALIAS] = connections.configure_settings({
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": path},
+        })["default"]
+        try:
+            # only the tables involved; the current model state is what gets measured
+            connection = connections[ALIAS]
+            with connection.schema_editor() as editor:
+                editor.create_model(Mesto)
+                editor.create_model(Klijenti)
+                editor.create_model(Dokumenti)
+            samples = self.seed(options["documents"], options["clients"])
+            queries = self.queries(samples)
+
+            indexes = [i for i in Dokumenti._meta.indexes if i.name in INDEX_NAMES]
+            with connection.schema_editor() as editor:
+                for index in indexes:
+                    editor.remove_index(Dokumenti, index)
+            before = self.measure(queries, options["repeat"])
+
+            with connection.schema_editor() as editor:
+                for index in indexes:
+                    editor.add_index(Dokumenti, index)
+            # without statistics for the new indexes the planner only guesses
+            self.analyze()
+            after = self.measure(queries, options["repeat"])
+
+            self.report(queries, before, after)
+        finally:
+            connections[ALIAS].close()
+            del connections[ALIAS]
+            del connections.settings[ALIAS]
+            os.unlink(path)
+
+    def seed(self, documents, clients):
+        rnd = random.Random(42)
+        db = Klijenti.objects.using(ALIAS)
+        db.bulk_create(
+            Klijenti(id=i, ime=f"Klijent {i}", pib=f"{100000000 + i}", mbr=f"{10000000 + i}", adresa="-")
+            for i in range(1, clients + 1)
+        )
+
+        start = date.today() - timedelta(days=5 * 365)
+        counts = {"IZF": documents // 2, "ULF": documents * 3 // 10}
+        counts["OTP"] = documents - counts["IZF"] - counts["ULF"]
+        docs = Dokumenti.objects.using(ALIAS)
+        for dok_tip, count in counts.items():
+            batch = []
+            for i in range(count):
+                day = start + timedelta(days=rnd.randrange(5 * 365))
+                batch.append(Dokumenti(
+                    klijent_id=rnd.randint(1, clients),
+                    dok_tip=dok_tip,
+                    dok_br=f"{dok_tip}-{i:07d}",
+                    dok_datum=day,
+                    prm_datum=day,
+                    iznos_P=rnd.randint(0, 100_000),
+                    salesInvoiceId=str(1_000_000 + i) if dok_tip == "IZF" else None,
+                    purchaseInvoiceId=str(2_000_000 + i) if dok_tip == "ULF" else None,
+                ))
+            docs.bulk_create(batch, batch_size=2000)
+
+        # most otpremnice are already linked to an invoice
+        invoice_ids = list(docs.filter(dok_tip="IZF").values_list("id", flat=True))
+        otp_ids = list(docs.filter(dok_tip="OTP").values_list("id", flat=True))
+        linked = rnd.sample(otp_ids, len(otp_ids) * 8 // 10)
+        for i in range(0, len(linked), 500):
+            docs.filter(id__in=linked[i:i + 500]).update(faktura_id=rnd.choice(invoice_ids))
+
+        self.analyze()
+        return {
+            "klijent": rnd.randint(1, clients),
+            "month": (date.today().replace(day=1) - timedelta(days=90)),
+            "year": date(date.today().year, 1, 1),
+            "purchase_id": str(2_000_000 + counts["ULF"] // 2),
+            "sales_id": str(1_000_000 + counts["IZF"] // 2),
+        }
+
+    def analyze(self):
+        with connections[ALIAS].cursor() as cursor:
+            cursor.execute("ANALYZE")
+
+    def queries(self, s):
+        """name -> (queryset, how the view evaluates it)"""
+        docs = Dokumenti.objects.using(ALIAS)
+        month_end = s["month"] + timedelta(days=30)
+        return {
+            "dokument_list (IZF, one month)": (
+                docs.filter(dok_tip="IZF", dok_datum__gte=s["month"], dok_datum__lte=month_end)
+                .order_by("dok_datum"),
+                lambda qs: list(qs[:10]),
+            ),
+            "kpo_pdf totals (IZF, this year)": (
+                docs.filter(dok_tip="IZF", dok_datum__gte=s["year"], dok_datum__lte=date.today()),
+                lambda qs: qs.aggregate(u=Sum("iznos_U"), p=Sum("iznos_P")),
+            ),
+            "available otpremnice": (
+                docs.filter(dok_tip="OTP", faktura__isnull=True, klijent_id=s["klijent"]),
+                list,
+            ),
+            "webhook purchaseInvoiceId": (
+                docs.filter(purchaseInvoiceId=s["purchase_id"]),
+                lambda qs: qs.first(),
+            ),
+            "webhook salesInvoiceId": (
+                docs.filter(salesInvoiceId=s["sales_id"]),
+                lambda qs: qs.first(),
+            ),
+        }
+
+    def measure(self, queries, repeat):
+        results = {}
+        for name, (qs, run) in queries.items():
+            timings = []
+            for _ in range(repeat):
+                t = time.perf_counter()
+                run(qs.all())
+                timings.append((time.perf_counter() - t) * 1000)
+            results[name] = (statistics.median(timings), qs.explain())
+        return results
+
+    def report(self, queries, before, after):
+        for name in queries:
+            ms_before, plan_before = before[name]
+            ms_after, plan_after = after[name]
+            self.stdout.write(self.style.MIGRATE_HEADING(name))
+            self.stdout.write(f"  before {ms_before:8.2f} ms  {plan_before}")
+            self.stdout.write(f"  after  {ms_after:8.2f} ms  {plan_after}")
@@ -0,0 +1,126 @@
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.db import OperationalError, connections, transaction
+from django.utils import timezone
+
+from gtbook.models import WebhookEvent
+
+ALIAS = "benchmark"
+PROFILES = {
+    "stock": {},
+    "production": settings.SQLITE_PRODUCTION_OPTIONS,
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Run concurrent readers and writers against a throwaway SQLite database "
+        "with the stock and the production connection profile and compare "
+        "throughput, latency and 'database is locked' errors"
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=4)
+        parser.add_argument("--writers", type=int, default=2)
+        parser.add_argument("--seconds", type=float, default=5.0)
+        parser.add_argument("--seed", type=int, default=20_000, help="Events in the table before the run")
+
+    def handle(self, *args, **options):
+        for profile, db_options in PROFILES.items():
+            stats = self.run_profile(db_options, options)
+            self.stdout.write(self.style.MIGRATE_HEADING(profile))
+            for role in ("read", "write"):
+                ops, errors, latencies = stats[role]
+                p50 = statistics.median(latencies) if latencies else 0
+                p95 = statistics.quantiles(latencies, n=20)[-1] if len(latencies) > 1 else p50
+                self.stdout.write(
+                    f"  {role:5} {ops / options['seconds']:8.0f} ops/s  "
+                    f"p50 {p50:6.2f} ms  p95 {p95:7.2f} ms  locked {errors}"
+                )
+
+    def run_profile(self, db_options, options):
+        fd, path = tempfile.mkstemp(prefix="gtbook-bench-", suffix=".sqlite3")
+        os.close(fd)
+        # configure_settings() fills in the defaults but insists on a "default" key
+        connections.settings[ALIAS] = connections.configure_settings({
+            "default": {"ENGINE": "django.db.backends.sqlite3", "NAME": path, "OPTIONS": db_options},
+        })["default"]
+        try:
+            with connections[ALIAS].schema_editor() as editor:
+                editor.create_model(WebhookEvent)
+            WebhookEvent.objects.using(ALIAS).bulk_create(
+                [WebhookEvent(payload={"InvoiceId": i}) for i in range(options["seed"])],
+                batch_size=2000,
+            )
+            connections[ALIAS].close()
+
+            stats = {"read": [0, 0, []], "write": [0, 0, []]}
+            lock = threading.Lock()
+            deadline = time.monotonic() + options["seconds"]
+            threads = [
+                threading.Thread(target=self.worker, args=(self.read, "read", deadline, stats, lock))
+                for _ in range(options["readers"])
+            ] + [
+                threading.Thread(target=self.worker, args=(self.write, "write", deadline, stats, lock))
+                for _ in range(options["writers"])
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            return stats
+        finally:
+            connections[ALIAS].close()
+            del connections[ALIAS]
+            del connections.settings[ALIAS]
+            for suffix in ("", "-wal", "-shm", "-journal"):
+                if os.path.exists(path + suffix):
+                    os.unlink(path + suffix)
+
+    def worker(self, op, role, deadline, stats, lock):
+        ops = errors = 0
+        latencies = []
+        try:
+            while time.monotonic() < deadline:
+                t = time.perf_counter()
+                try:
+                    op()
+                except OperationalError as e:
+                    if "locked" not in str(e):
+                        raise
+                    errors += 1
+                    continue
+                latencies.append((time.perf_counter() - t) * 1000)
+                ops += 1
+        finally:
+            connections[ALIAS].close()
+        with lock:
+            stats[role][0] += ops
+            stats[role][1] += errors
+            stats[role][2] += latencies
+
+    @staticmethod
+    def read():
+        # the webhook admin page: a count and the oldest pending events
+        events = WebhookEvent.objects.using(ALIAS).filter(status="pending")
+        events.count()
+        list(events.order_by("id").values("id", "type", "received_at")[:50])
+
+    @staticmethod
+    def write():
+        # a webhook callback followed by a worker claiming it: read, then write
+        # in one transaction — the lock upgrade that fails without IMMEDIATE
+        events = WebhookEvent.objects.using(ALIAS)
+        events.bulk_create([WebhookEvent(payload={"InvoiceId": 0}) for _ in range(5)])
+        with transaction.atomic(using=ALIAS):
+            ids = list(
+                events.filter(status="pending", claimed_at__isnull=True)
+                .order_by("id").values_list("id", flat=True)[:5]
+            )
+            events.filter(id__in=ids).update(claimed_at=timezone.now(), claimed_by="benchmark")
@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from gtbook.utils.blob_store import COMPRESSION_SUFFIXES
+from gtbook.utils.media_gc import compress_attachments
+
+
+class Command(BaseCommand):
+    help = "Compress stored XML attachments (reads stay transparent)"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--format", choices=sorted(COMPRESSION_SUFFIXES),
+            default=settings.ATTACHMENT_COMPRESSION or "gzip",
+            help="Compression to use (default: ATTACHMENT_COMPRESSION, else gzip)",
+        )
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only count the files that would be compressed",
+        )
+
+    def handle(self, *args, **options):
+        files, before, after = compress_attachments(options["format"], dry_run=options["dry_run"])
+        if options["dry_run"]:
+            self.stdout.write(f"Would compress {files} file(s), {before / 1e6:.1f} MB")
+            return
+        ratio = after / before if before else 1
+        self.stdout.write(self.style.SUCCESS(
+            f"Compressed {files} file(s): {before / 1e6:.1f} MB -> {after / 1e6:.1f} MB "
+            f"({ratio:.0%})"
+        ))
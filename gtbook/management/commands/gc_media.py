@@ -0,0 +1,46 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from gtbook.utils.media_gc import gc_blobs, gc_sef_tmp, migrate_to_blobs
+
+
+class Command(BaseCommand):
+    help = "Remove orphaned sef_tmp files and unreferenced attachment blobs"
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--dry-run", action="store_true",
+            help="Only report what would be removed",
+        )
+        parser.add_argument(
+            "--min-age", type=float, default=1.0,
+            help="Hours a file must be untouched before it may be removed",
+        )
+        parser.add_argument(
+            "--stale-days", type=float, default=7.0,
+            help="Remove any sef_tmp file older than this many days",
+        )
+        parser.add_argument(
+            "--migrate", action="store_true",
+            help="First move attachments saved before the blob store into it",
+        )
+
+    def handle(self, *args, **options):
+        dry_run = options["dry_run"]
+        min_age = timedelta(hours=options["min_age"])
+        verb = "Would remove" if dry_run else "Removed"
+
+        if options["migrate"]:
+            migrated = migrate_to_blobs(dry_run=dry_run)
+            self.stdout.write(f"{'Would migrate' if dry_run else 'Migrated'} {migrated} attachment(s)")
+
+        tmp_files = gc_sef_tmp(min_age, timedelta(days=options["stale_days"]), dry_run=dry_run)
+        blobs = gc_blobs(min_age, dry_run=dry_run)
+
+        if options["verbosity"] > 1:
+            for path in tmp_files:
+                self.stdout.write(f"  {path}")
+            for name in blobs:
+                self.stdout.write(f"  {name}")
+        self.stdout.write(f"{verb} {len(tmp_files)} sef_tmp file(s) and {len(blobs)} blob(s)")
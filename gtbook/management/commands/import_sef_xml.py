@@ -0,0 +1,73 @@
+import os
+import time
+from itertools import islice
+from pathlib import Path
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gtbook.utils.sef_import import SefImporter, parse_files
+
+
+class Command(BaseCommand):
+    help = "Import archived SEF invoice XMLs from a directory into Dokumenti"
+
+    def add_arguments(self, parser):
+        parser.add_argument("directory", help="Directory searched recursively for *.xml")
+        parser.add_argument(
+            "--workers", type=int, default=os.cpu_count() or 1,
+            help="Parser processes (1 = parse in this process)",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=500,
+            help="Invoices written per transaction",
+        )
+        parser.add_argument(
+            "--no-files", action="store_true",
+            help="Don't attach the XML to the imported documents",
+        )
+
+    def handle(self, *args, **options):
+        directory = Path(options["directory"])
+        batch_size = options["batch_size"]
+        if not directory.is_dir():
+            raise CommandError(f"{directory} is not a directory")
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
+
+        paths = sorted(str(p) for p in directory.rglob("*.xml"))
+        self.stdout.write(f"Found {len(paths)} XML file(s)")
+
+        importer = SefImporter(attach_files=not options["no_files"])
+        results = parse_files(paths, workers=options["workers"])
+        start = time.perf_counter()
+        done = 0
+
+        while batch := list(islice(results, batch_size)):
+            parsed = []
+            for path, data, error in batch:
+                if error:
+                    importer.fail(path, error)
+                else:
+                    parsed.append((path, data))
+            # counts every file once (imported, skipped or failed) by itself
+            importer.import_batch(parsed)
+
+            done += len(batch)
+            elapsed = time.perf_counter() - start
+            self.stdout.write(
+                f"{done}/{len(paths)} files, {importer.stats['imported']} imported "
+                f"({done / elapsed:.0f} files/s)"
+            )
+
+        for path, error in importer.errors:
+            self.stderr.write(f"{path}: {error}")
+
+        elapsed = time.perf_counter() - start
+        stats = importer.stats
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {stats['imported']} invoice(s) with {stats['items']} item(s), "
+            f"{stats['clients']} new client(s); skipped {stats['skipped']}, "
+            f"failed {stats['failed']} in {elapsed:.1f}s "
+            f"({len(paths) / elapsed if elapsed else 0:.0f} files/s, "
+            f"{stats['imported'] / elapsed if elapsed else 0:.0f} invoices/s)"
+        ))
@@ -1,41 +1,103 @@
-from django.core.management.base import BaseCommand
+import logging
+import signal
+import threading
+
+from django.core.management.base import BaseCommand, CommandError
 from django.utils import timezone
-from django.db import transaction
 
-from gtbook.models import WebhookEvent
-from gtbook.utils.webhook_processing import process_webhook
+from gtbook.utils.webhook_worker import (
+    DEFAULT_LEASE_SECONDS, WORKER_MODES, default_worker_id, process_pending,
+    revive_dead_events, run_daemon,
+)
+
+logger = logging.getLogger(__name__)
 
 
 class Command(BaseCommand):
     help = "Process pending webhook events"
 
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--workers", type=int, default=1,
+            help="Number of parallel workers (1 = process serially)",
+        )
+        parser.add_argument(
+            "--mode", choices=WORKER_MODES, default="thread",
+            help="Worker pool type used when --workers > 1",
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=50,
+            help="Number of events claimed per batch",
+        )
+        parser.add_argument(
+            "--daemon", action="store_true",
+            help="Keep running and poll for new events instead of exiting when idle",
+        )
+        parser.add_argument(
+            "--lease", type=int, default=DEFAULT_LEASE_SECONDS,
+            help="Seconds a claimed event stays reserved before others may reclaim it",
+        )
+        parser.add_argument(
+            "--poll-interval", type=float, default=1.0,
+            help="Initial sleep (seconds) when idle in daemon mode",
+        )
+        parser.add_argument(
+            "--max-poll-interval", type=float, default=30.0,
+            help="Upper bound for the idle backoff in daemon mode",
+        )
+        parser.add_argument(
+            "--retry-dead", action="store_true",
+            help="Re-queue dead-lettered events with a fresh retry budget first",
+        )
+
     def handle(self, *args, **options):
-        pending = (WebhookEvent.objects.select_for_update(skip_locked=True))
+        workers = options["workers"]
+        batch_size = options["batch_size"]
+        if workers < 1:
+            raise CommandError("--workers must be at least 1")
+        if batch_size < 1:
+            raise CommandError("--batch-size must be at least 1")
 
-        processed_count = 0
+        if options["retry_dead"]:
+            self.stdout.write(f"Re-queued {revive_dead_events()} dead webhook(s)")
+
+        def report(webhook_id, success, error):
+            if success:
+                logger.debug("event=webhook.processed webhook_id=%s", webhook_id)
+            else:
+                logger.warning("event=webhook.failed webhook_id=%s\n%s", webhook_id, error)
+
+        worker_id = default_worker_id()
+        common = dict(
+            workers=workers,
+            mode=options["mode"],
+            batch_size=batch_size,
+            on_result=report,
+            worker_id=worker_id,
+            lease_seconds=options["lease"],
+        )
 
-        for webhook in pending:
-            print("Processing webhook:", webhook.id)
-            try:
-                with transaction.atomic():
-                    success, error = process_webhook(webhook)
-                    if success:
-                        webhook.delete()
-                    else:
-                        raise Exception(error)
+        if options["daemon"]:
+            stop_event = threading.Event()
 
-                processed_count += 1
+            def stop(signum, frame):
+                self.stdout.write("Stopping after the current batch...")
+                stop_event.set()
 
-            # except Exception as e:
-            #     webhook.error = str(e)
-            #     webhook.save(update_fields=["error"])
-            except Exception as e:
-                import traceback
-                webhook.error = traceback.format_exc()
-                webhook.save(update_fields=["error"])
-                raise
+            signal.signal(signal.SIGINT, stop)
+            signal.signal(signal.SIGTERM, stop)
 
+            self.stdout.write(f"[{timezone.now()}] Webhook daemon {worker_id} started")
+            processed_count, failed_count = run_daemon(
+                stop_event,
+                poll_interval=options["poll_interval"],
+                max_poll_interval=options["max_poll_interval"],
+                **common,
+            )
+        else:
+            processed_count, failed_count = process_pending(**common)
 
         self.stdout.write(
-            f"[{timezone.now()}] Processed {processed_count} webhook(s)"
+            f"[{timezone.now()}] Processed {processed_count} webhook(s), "
+            f"failed {failed_count}"
         )
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 12:55
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0033_webhookevent_attempts_webhookevent_next_attempt_at_and_more'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='webhooklog',
+            name='timestamp',
+            field=models.DateTimeField(auto_now_add=True, db_index=True),
+        ),
+    ]
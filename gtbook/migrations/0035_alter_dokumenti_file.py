@@ -0,0 +1,20 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:05
+
+import gtbook.models
+import gtbook.utils.blob_store
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0034_alter_webhooklog_timestamp'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='dokumenti',
+            name='file',
+            field=models.FileField(blank=True, null=True, storage=gtbook.utils.blob_store.ContentAddressedStorage(), upload_to='documents/%Y/%m/%d/', validators=[gtbook.models.validate_file_extension]),
+        ),
+    ]
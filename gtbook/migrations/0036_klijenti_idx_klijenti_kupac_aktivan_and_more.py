@@ -0,0 +1,21 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:08
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0035_alter_dokumenti_file'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='klijenti',
+            index=models.Index(condition=models.Q(('defcode__bitand', 17)), fields=['id'], name='idx_klijenti_kupac_aktivan'),
+        ),
+        migrations.AddIndex(
+            model_name='klijenti',
+            index=models.Index(condition=models.Q(('defcode__bitand', 18)), fields=['id'], name='idx_klijenti_dobavljac_aktivan'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0036_klijenti_idx_klijenti_kupac_aktivan_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='dokumenti',
+            index=models.Index(fields=['dok_tip', 'dok_datum'], name='idx_dokumenti_tip_datum'),
+        ),
+        migrations.AddIndex(
+            model_name='dokumenti',
+            index=models.Index(condition=models.Q(('salesInvoiceId__isnull', False)), fields=['salesInvoiceId'], name='idx_dokumenti_sales_id'),
+        ),
+        migrations.AddIndex(
+            model_name='dokumenti',
+            index=models.Index(condition=models.Q(('purchaseInvoiceId__isnull', False)), fields=['purchaseInvoiceId'], name='idx_dokumenti_purchase_id'),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0037_dokumenti_idx_dokumenti_tip_datum_and_more'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DokumentBrojac',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('dok_tip', models.CharField(choices=[('IZF', 'IZLAZNA FAKTURA'), ('ULF', 'ULAZNA FAKTURA'), ('OTP', 'OTPREMNICA')], max_length=3)),
+                ('godina', models.PositiveSmallIntegerField()),
+                ('poslednji', models.PositiveIntegerField(default=0)),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('dok_tip', 'godina'), name='uniq_brojac_tip_godina')],
+            },
+        ),
+    ]
@@ -0,0 +1,58 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:19
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import F
+
+# napomena of the otpremnice dokument_create / dokument_edit create from an invoice
+AUTO_OTP_NAPOMENA = "Automatski kreirana otpremnica za "
+
+
+def backfill_source_otp(apps, schema_editor):
+    # Items copied before this field existed: pair each item of a linked
+    # otpremnica with one identical, still unpaired invoice item.
+    # Otpremnice created from the invoice itself (otp-switch) are skipped:
+    # their items are copies of the invoice's own items, which must not be
+    # removed when such an otpremnica is unlinked.
+    db = schema_editor.connection.alias
+    Dokumenti = apps.get_model("gtbook", "Dokumenti")
+    FakturaStavka = apps.get_model("gtbook", "FakturaStavka")
+    OtpremnicaStavka = apps.get_model("gtbook", "OtpremnicaStavka")
+
+    key_fields = ("naziv", "kolicina", "cena", "jed_mere")
+    linked = Dokumenti.objects.using(db).filter(dok_tip="OTP", faktura__isnull=False).exclude(
+        napomena__startswith=AUTO_OTP_NAPOMENA,
+        dok_datum=F("faktura__dok_datum"),
+        klijent=F("faktura__klijent"),
+    )
+    for otp_id, faktura_id in linked.values_list("id", "faktura_id"):
+        unpaired = {}
+        for item in FakturaStavka.objects.using(db).filter(
+            faktura_id=faktura_id, source_otp__isnull=True
+        ).order_by("id"):
+            unpaired.setdefault(tuple(getattr(item, f) for f in key_fields), []).append(item)
+
+        paired = []
+        for otp_item in OtpremnicaStavka.objects.using(db).filter(otpremnica_id=otp_id).order_by("id"):
+            candidates = unpaired.get(tuple(getattr(otp_item, f) for f in key_fields))
+            if candidates:
+                item = candidates.pop(0)
+                item.source_otp_id = otp_item.id
+                paired.append(item)
+        FakturaStavka.objects.using(db).bulk_update(paired, ["source_otp"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0038_dokumentbrojac'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='fakturastavka',
+            name='source_otp',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='faktura_stavke', to='gtbook.otpremnicastavka'),
+        ),
+        migrations.RunPython(backfill_source_otp, migrations.RunPython.noop),
+    ]
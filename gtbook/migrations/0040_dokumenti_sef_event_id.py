@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 13:44
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gtbook', '0039_fakturastavka_source_otp'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dokumenti',
+            name='sef_event_id',
+            field=models.BigIntegerField(blank=True, null=True),
+        ),
+    ]
@@ -1,21 +1,39 @@
 # gtbook/models.py
-from datetime import date
+from datetime import date, timedelta
+from django.conf import settings
 from django.utils import timezone
 from django.db import models
+from django.db.models import Q
 from django.core.validators import RegexValidator
 from django.forms import ValidationError
 from django.utils.translation import gettext_lazy as _
+from gtbook.utils.blob_store import ContentAddressedStorage
 
 numeric_validator = RegexValidator(r'^\d+$', 'Dozvoljeni su samo brojevi.')
 
+DEF_KUPAC, DEF_DOBAVLJAC, DEF_SEF, DEF_CRF, DEF_AKTIVAN = (1 << i for i in range(5))
+
 DEF_OPT = [
-    (1 << 0, "Kupac"),
-    (1 << 1, "Dobavljač"),
-    (1 << 2, "SEF"),
-    (1 << 3, "CRF"),
-    (1 << 4, "Aktivan"),
+    (DEF_KUPAC, "Kupac"),
+    (DEF_DOBAVLJAC, "Dobavljač"),
+    (DEF_SEF, "SEF"),
+    (DEF_CRF, "CRF"),
+    (DEF_AKTIVAN, "Aktivan"),
 ]
 
+@models.IntegerField.register_lookup
+class BitAnd(models.Lookup):
+    """
+    `defcode__bitand=mask` — every bit of `mask` is set. The mask is inlined
+    as a literal, so the SQL matches the partial indexes on Klijenti.
+    """
+    lookup_name = "bitand"
+
+    def as_sql(self, compiler, connection):
+        lhs, params = self.process_lhs(compiler, connection)
+        mask = int(self.rhs)
+        return f"({lhs} & {mask}) = {mask}", params
+
 class Mesto(models.Model):
     grad = models.CharField(max_length=100, unique=True)
     post_code = models.CharField(max_length=10)
@@ -51,6 +69,19 @@ class Klijenti(models.Model):
     website = models.URLField(blank=True, null=True)
     defcode = models.IntegerField(default=17) # 5-bitni bitmask za kupac/dobavljac/sef/crf/aktivan <- default kupac-aktivan
 
+    class Meta:
+        indexes = [
+            # client dropdowns on document forms only read these subsets
+            models.Index(
+                fields=["id"], name="idx_klijenti_kupac_aktivan",
+                condition=Q(defcode__bitand=DEF_KUPAC | DEF_AKTIVAN),
+            ),
+            models.Index(
+                fields=["id"], name="idx_klijenti_dobavljac_aktivan",
+                condition=Q(defcode__bitand=DEF_DOBAVLJAC | DEF_AKTIVAN),
+            ),
+        ]
+
     def __str__(self):
         return f"{self.id} - {self.ime}"
 
@@ -97,6 +128,8 @@ class Dokumenti (models.Model):
     salesInvoiceId = models.CharField(max_length=25, blank=True, null=True)
     purchaseInvoiceId = models.CharField(max_length=25, blank=True, null=True)
     invoiceId = models.CharField(max_length=25)
+    # WebhookEvent id whose SEF status is applied; older (retried) events are skipped
+    sef_event_id = models.BigIntegerField(null=True, blank=True)
     napomena = models.TextField(blank=True, null=True)
     # Self-referential ForeignKey - veza otpremnice sa fakturom
     faktura = models.ForeignKey(
@@ -108,6 +141,7 @@ class Dokumenti (models.Model):
     )
     file = models.FileField(
         upload_to="documents/%Y/%m/%d/",
+        storage=ContentAddressedStorage(),   # stored once per SHA-256, see blob_store
         validators=[validate_file_extension],
         null=True,
         blank=True
@@ -129,10 +163,37 @@ class Dokumenti (models.Model):
                 name='idx_dokumenti_unique'
             )
         ]
+        indexes = [
+            # dokument_list / kpo_pdf: one type within a date range
+            models.Index(fields=['dok_tip', 'dok_datum'], name='idx_dokumenti_tip_datum'),
+            # webhook lookups; each id is set on one invoice type only
+            models.Index(
+                fields=['salesInvoiceId'], name='idx_dokumenti_sales_id',
+                condition=Q(salesInvoiceId__isnull=False),
+            ),
+            models.Index(
+                fields=['purchaseInvoiceId'], name='idx_dokumenti_purchase_id',
+                condition=Q(purchaseInvoiceId__isnull=False),
+            ),
+        ]
 
     def __str__(self):
         return f"{self.get_dok_tip_display()} #{self.dok_br}"
-    
+
+class DokumentBrojac(models.Model):
+    """Last document number handed out per type and year (utils.reserve_dok_number)."""
+    dok_tip = models.CharField(max_length=3, choices=Dokumenti.TIPOVI_DOK)
+    godina = models.PositiveSmallIntegerField()
+    poslednji = models.PositiveIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['dok_tip', 'godina'], name='uniq_brojac_tip_godina'),
+        ]
+
+    def __str__(self):
+        return f"{self.dok_tip} {self.godina}: {self.poslednji}"
+
 # ---------------------------------------------------------
 #  Base item model (abstract)
 # ---------------------------------------------------------
@@ -170,6 +231,14 @@ class FakturaStavka(BaseStavka):
         on_delete=models.CASCADE,
         related_name='stavke_izf'
     )
+    # the otpremnica item this row was copied from (linking OTP → IZF)
+    source_otp = models.ForeignKey(
+        'OtpremnicaStavka',
+        on_delete=models.SET_NULL,
+        null=True,
+        blank=True,
+        related_name='faktura_stavke'
+    )
     def __str__(self):
         return f"Faktura stavka {self.naziv}"
 
@@ -192,6 +261,10 @@ class UlaznaFakturaStavka(BaseStavka):
         return f"Ulazna faktura stavka {self.naziv}"
 
 class WebhookEvent(models.Model):
+    STATUS = [
+        ("pending", "Na čekanju"),
+        ("dead", "Neuspešno"),   # dead-letter: retries exhausted or permanent error
+    ]
     received_at = models.DateTimeField(auto_now_add=True)
     payload = models.JSONField()
     type = models.CharField(max_length=20, default="izlazne", choices=[
@@ -200,12 +273,18 @@ class WebhookEvent(models.Model):
         ])
     error = models.TextField(null=True, blank=True)
     # processed = models.BooleanField(default=False)
+    status = models.CharField(max_length=10, choices=STATUS, default="pending")
+    attempts = models.PositiveSmallIntegerField(default=0)
+    next_attempt_at = models.DateTimeField(null=True, blank=True)  # NULL = as soon as possible
+    # lease: a worker owns the event until claimed_at + lease expires
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    claimed_by = models.CharField(max_length=100, null=True, blank=True)
     
     def __str__(self):
         return f"Webhook {self.id} ({self.type}) @ {self.received_at}"
     
 class WebhookLog(models.Model):
-    timestamp = models.DateTimeField(auto_now_add=True)
+    timestamp = models.DateTimeField(auto_now_add=True, db_index=True)
     webhook_id = models.IntegerField()
     doc_number = models.CharField(max_length=50, blank=True, null=True)
     client_name = models.CharField(max_length=255, blank=True, null=True)
@@ -218,18 +297,34 @@ class WebhookLog(models.Model):
         return f"{self.timestamp} | {self.doc_number} | {self.client_name}"
     
     @staticmethod
-    def trim(max_entries=500):
-        total = WebhookLog.objects.count()
-        if total > max_entries:
-            # Calculate how many oldest entries to delete
-            delete_count = total - max_entries
-
-            # Select oldest entries and delete them
-            oldest = (
-                WebhookLog.objects.order_by('timestamp')
-                .values_list('id', flat=True)[:delete_count]
+    def trim(max_entries=None, max_age=None):
+        """
+        Delete entries beyond the newest `max_entries` and/or older than
+        `max_age` (timedelta). Defaults come from WEBHOOK_LOG_MAX_ENTRIES and
+        WEBHOOK_LOG_MAX_AGE_DAYS; 0/None disables a policy.
+        Both policies resolve to a (timestamp, id) cutoff, so this is one
+        indexed lookup plus a single DELETE — no COUNT(*) over the table.
+        """
+        if max_entries is None:
+            max_entries = settings.WEBHOOK_LOG_MAX_ENTRIES
+        if max_age is None and settings.WEBHOOK_LOG_MAX_AGE_DAYS:
+            max_age = timedelta(days=settings.WEBHOOK_LOG_MAX_AGE_DAYS)
+
+        cutoff = Q()
+        if max_entries:
+            # the newest entry that no longer fits; id breaks timestamp ties
+            boundary = list(
+                WebhookLog.objects.order_by('-timestamp', '-id')
+                .values_list('timestamp', 'id')[max_entries:max_entries + 1]
             )
-            WebhookLog.objects.filter(id__in=oldest).delete()
+            if boundary:
+                timestamp, entry_id = boundary[0]
+                cutoff |= Q(timestamp__lt=timestamp) | Q(timestamp=timestamp, id__lte=entry_id)
+        if max_age:
+            cutoff |= Q(timestamp__lt=timezone.now() - max_age)
+
+        if cutoff:
+            WebhookLog.objects.filter(cutoff).delete()
 
 class Transakcije(models.Model):
     TIP_TRANSAKCIJE = [
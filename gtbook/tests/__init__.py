@@ -0,0 +1,7 @@
+from unittest import skipUnless
+
+from django.db import connection
+
+# SQLite serialises writers, so the concurrent worker and ingest paths are
+# only exercised against PostgreSQL: DB_ENGINE=postgres python manage.py test gtbook
+requires_postgres = skipUnless(connection.vendor == "postgresql", "needs DB_ENGINE=postgres")
@@ -0,0 +1,67 @@
+from datetime import date
+from decimal import Decimal
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from gtbook.models import Dokumenti, FakturaStavka, Klijenti, OtpremnicaStavka
+
+# session, user, document, clients, formset items, linked and available
+# otpremnice with their previews — none of it may depend on the number of rows
+EDIT_PAGE_QUERIES = 12
+
+
+class DokumentEditQueryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("t")
+        # defcode 17: active customer, so the client shows up in the IZF dropdown
+        cls.klijent = Klijenti.objects.create(ime="Kupac", pib="100000001", mbr="10000001", adresa="-", defcode=17)
+        cls.izf = Dokumenti.objects.create(
+            klijent=cls.klijent, dok_tip="IZF", dok_br="260001", dok_datum=date(2026, 3, 1),
+        )
+        FakturaStavka.objects.create(faktura=cls.izf, naziv="Montaža", kolicina=Decimal("1"), cena=Decimal("3000"))
+        # one linked and one available otpremnica: without any the previews query is skipped
+        cls.add_otpremnice(1, faktura=cls.izf)
+        cls.add_otpremnice(1)
+
+    def setUp(self):
+        # TailscaleProtectMiddleware lets only tailnet visitors through
+        self.client = self.client_class(headers={"Tailscale-User-Login": "t"})
+        self.client.force_login(self.user)
+
+    @classmethod
+    def add_otpremnice(cls, count, faktura=None):
+        for _ in range(count):
+            otp = Dokumenti.objects.create(
+                klijent=cls.klijent, dok_tip="OTP", dok_br=f"OT-{Dokumenti.objects.count()}",
+                faktura=faktura,
+            )
+            OtpremnicaStavka.objects.bulk_create(
+                OtpremnicaStavka(otpremnica=otp, naziv=f"Stavka {n}", kolicina=Decimal("1"), cena=Decimal("10"))
+                for n in range(3)
+            )
+
+    def get_edit_page(self):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse("dokument_edit", args=[self.izf.id]))
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_query_count(self):
+        with self.assertNumQueries(EDIT_PAGE_QUERIES):
+            self.client.get(reverse("dokument_edit", args=[self.izf.id]))
+
+    def test_query_count_independent_of_otpremnice(self):
+        _, baseline = self.get_edit_page()
+        self.add_otpremnice(5, faktura=self.izf)
+        self.add_otpremnice(5)
+        response, count = self.get_edit_page()
+        self.assertEqual(count, baseline)
+        self.assertEqual(len(response.context["linked_otps"]), 6)
+        self.assertEqual(len(response.context["available_otpremnice"]), 6)
+        # previews are rendered from the single items query
+        self.assertIn("Stavka 2", response.context["linked_otps"][0].preview)
@@ -0,0 +1,83 @@
+from datetime import date
+from decimal import Decimal
+from importlib import import_module
+from types import SimpleNamespace
+
+from django.apps import apps
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import TestCase
+from django.urls import reverse
+
+from gtbook.models import Dokumenti, FakturaStavka, Klijenti, OtpremnicaStavka
+
+backfill_source_otp = import_module("gtbook.migrations.0039_fakturastavka_source_otp").backfill_source_otp
+
+ITEMS = [("Kabl", Decimal("2"), Decimal("150")), ("Montaža", Decimal("1"), Decimal("3000"))]
+
+
+class BackfillSourceOtpTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = User.objects.create_user("t")
+        cls.klijent = Klijenti.objects.create(ime="Kupac", pib="100000001", mbr="10000001", adresa="-")
+        cls.izf = Dokumenti.objects.create(
+            klijent=cls.klijent, dok_tip="IZF", dok_br="260001", dok_datum=date(2026, 3, 1),
+        )
+        FakturaStavka.objects.bulk_create(
+            FakturaStavka(faktura=cls.izf, naziv=naziv, kolicina=kolicina, cena=cena)
+            for naziv, kolicina, cena in ITEMS
+        )
+
+    def setUp(self):
+        # TailscaleProtectMiddleware lets only tailnet visitors through
+        self.client = self.client_class(headers={"Tailscale-User-Login": "t"})
+        self.client.force_login(self.user)
+
+    def add_otp(self, dok_br, napomena=None, items=ITEMS):
+        otp = Dokumenti.objects.create(
+            klijent=self.klijent, dok_tip="OTP", dok_br=dok_br, dok_datum=self.izf.dok_datum,
+            faktura=self.izf, napomena=napomena,
+        )
+        OtpremnicaStavka.objects.bulk_create(
+            OtpremnicaStavka(otpremnica=otp, naziv=naziv, kolicina=kolicina, cena=cena)
+            for naziv, kolicina, cena in items
+        )
+        return otp
+
+    def backfill(self):
+        backfill_source_otp(apps, SimpleNamespace(connection=connection))
+
+    def unlink(self, otp):
+        response = self.client.post(reverse("unlink_otp_from_izf", args=[self.izf.id, otp.id]))
+        self.assertRedirects(response, reverse("dokument_edit", args=[self.izf.id]), fetch_redirect_response=False)
+
+    def test_auto_created_otp_is_not_backfilled(self):
+        otp = self.add_otp("OT-260001", napomena=f"Automatski kreirana otpremnica za IZF #{self.izf.dok_br}")
+        self.backfill()
+        self.assertFalse(FakturaStavka.objects.filter(source_otp__isnull=False).exists())
+
+        self.unlink(otp)
+        self.assertEqual(self.izf.stavke_izf.count(), len(ITEMS))
+        self.izf.refresh_from_db()
+        self.assertEqual(self.izf.iznos_U, Decimal("3300"))
+
+    def test_linked_otp_is_backfilled(self):
+        # an otpremnica linked later: its items were copied into the invoice
+        FakturaStavka.objects.create(faktura=self.izf, naziv="Kabl", kolicina=Decimal("2"), cena=Decimal("150"))
+        otp = self.add_otp("OT-260002", items=ITEMS[:1])
+        self.backfill()
+        self.assertEqual(FakturaStavka.objects.filter(source_otp__otpremnica=otp).count(), 1)
+
+        self.unlink(otp)
+        self.assertEqual(
+            sorted(self.izf.stavke_izf.values_list("naziv", flat=True)), ["Kabl", "Montaža"],
+        )
+        self.assertFalse(Dokumenti.objects.filter(pk=otp.pk, faktura__isnull=False).exists())
+
+    def test_auto_napomena_on_other_date_is_backfilled(self):
+        # same napomena, but not the invoice's own otpremnica: treated as linked
+        otp = self.add_otp("OT-260003", napomena="Automatski kreirana otpremnica za IZF #250099", items=ITEMS[:1])
+        Dokumenti.objects.filter(pk=otp.pk).update(dok_datum=date(2026, 2, 1))
+        self.backfill()
+        self.assertEqual(FakturaStavka.objects.filter(source_otp__otpremnica=otp).count(), 1)
@@ -0,0 +1,84 @@
+import io
+import tempfile
+from pathlib import Path
+from unittest import mock
+
+from django.core.management import call_command
+from django.test import TestCase
+
+from gtbook.models import Dokumenti, Klijenti, UlaznaFakturaStavka
+from gtbook.tests.test_xml_extract import ENVELOPE
+from gtbook.utils.sef_import import SefImporter
+
+
+def extracted(sef_id, dok_br, pib="RS100000001", issue_date="2026-03-01"):
+    return {
+        "header": {"PurchaseInvoiceId": sef_id},
+        "invoice": {
+            "ID": dok_br, "IssueDate": issue_date, "DueDate": issue_date, "PayableAmount": "100.00",
+            "Supplier": {"Name": "Dobavljač", "PIB": pib, "MBR": "10000001", "Address": "Glavna 1"},
+        },
+        "lines": [{"ItemName": "Kabl", "InvoicedQuantity": "2", "PriceAmount": "50.00", "UnitCode": "H87"}],
+    }
+
+
+class SefImporterTests(TestCase):
+    def import_batch(self, parsed):
+        importer = SefImporter(attach_files=False)
+        importer.import_batch(parsed)
+        return importer
+
+    def test_invalid_file_fails_alone(self):
+        importer = self.import_batch([
+            ("a.xml", extracted("1", "F-1")),
+            ("b.xml", extracted("2", "F-2", issue_date="2026-13-45")),
+            ("c.xml", extracted("3", "F-3")),
+        ])
+        self.assertEqual(importer.stats["imported"], 2)
+        self.assertEqual(importer.stats["failed"], 1)
+        self.assertEqual([path for path, _ in importer.errors], ["b.xml"])
+        self.assertIn("dok_datum", importer.errors[0][1])
+        self.assertEqual(sorted(Dokumenti.objects.values_list("dok_br", flat=True)), ["F-1", "F-3"])
+        self.assertEqual(Klijenti.objects.count(), 1)
+        self.assertEqual(UlaznaFakturaStavka.objects.count(), 2)
+
+    def test_failed_insert_is_retried_row_by_row(self):
+        # someone else stored F-2 after the duplicate check: the batch insert fails
+        klijent = Klijenti.objects.create(ime="Drugi", pib="100000009", mbr="1", adresa="-")
+        Dokumenti.objects.create(klijent=klijent, dok_tip="ULF", dok_br="F-2")
+        with mock.patch.object(SefImporter, "_existing", return_value=(set(), set())), \
+                self.assertLogs("gtbook.utils.sef_import", "WARNING"):
+            importer = self.import_batch([
+                ("a.xml", extracted("1", "F-1")),
+                ("b.xml", extracted("2", "F-2")),
+                ("c.xml", extracted("3", "F-3", pib="RS100000002")),
+            ])
+        self.assertEqual(importer.stats["imported"], 2)
+        self.assertEqual(importer.stats["failed"], 1)
+        self.assertEqual(importer.stats["clients"], 2)
+        self.assertEqual([path for path, _ in importer.errors], ["b.xml"])
+        self.assertEqual(
+            sorted(Dokumenti.objects.filter(purchaseInvoiceId__isnull=False).values_list("dok_br", flat=True)),
+            ["F-1", "F-3"],
+        )
+        self.assertEqual(UlaznaFakturaStavka.objects.count(), 2)
+
+    def test_rerun_skips_imported(self):
+        parsed = [("a.xml", extracted("1", "F-1")), ("b.xml", extracted("2", "F-2"))]
+        self.import_batch(parsed)
+        importer = self.import_batch(parsed)
+        self.assertEqual(importer.stats["skipped"], 2)
+        self.assertEqual(importer.stats["imported"], 0)
+
+
+class ImportSefXmlCommandTests(TestCase):
+    def test_each_file_counted_once(self):
+        with tempfile.TemporaryDirectory() as directory:
+            Path(directory, "good.xml").write_bytes(ENVELOPE)
+            Path(directory, "broken.xml").write_bytes(b"<env:DocumentEnvelope")
+            Path(directory, "no_id.xml").write_bytes(ENVELOPE.replace(b"<cbc:ID>26-0042</cbc:ID>", b""))
+            out, err = io.StringIO(), io.StringIO()
+            call_command("import_sef_xml", directory, workers=1, no_files=True, stdout=out, stderr=err)
+        self.assertIn("Imported 1 invoice(s)", out.getvalue())
+        self.assertIn("failed 2", out.getvalue())
+        self.assertEqual(len(err.getvalue().splitlines()), 2)
@@ -0,0 +1,98 @@
+import threading
+
+from django.db import connection
+from django.test import TestCase, TransactionTestCase
+
+from gtbook.models import WebhookEvent
+from gtbook.tests import requires_postgres
+from gtbook.utils.webhook_ingest import WebhookIngestBuffer, WebhookIngestError, _Batch
+
+
+def events(*ids):
+    return [WebhookEvent(payload={"InvoiceId": i}, type="izlazne") for i in ids]
+
+
+def stored_ids():
+    return sorted(e.payload["InvoiceId"] for e in WebhookEvent.objects.all())
+
+
+class WebhookIngestBufferTests(TestCase):
+    def test_single_request_is_written(self):
+        buffer = WebhookIngestBuffer(max_wait=0.01)
+        self.assertEqual(buffer.submit(events(1, 2)), 2)
+        self.assertEqual(stored_ids(), [1, 2])
+        self.assertIsNone(buffer._open)
+
+    def test_follower_of_a_stalled_leader_writes_its_own_rows(self):
+        buffer = WebhookIngestBuffer(wait_timeout=0.05)
+        # a leader that opened the batch and never got to flush it
+        stalled = buffer._open = _Batch()
+        stalled.rows = events(1)
+        self.assertEqual(buffer.submit(events(2, 3)), 2)
+        self.assertEqual(stored_ids(), [2, 3])
+        # the leader still flushes only its own row
+        self.assertEqual([row.payload["InvoiceId"] for row in stalled.rows], [1])
+
+    def test_follower_of_a_hung_flush_gives_up(self):
+        buffer = WebhookIngestBuffer(wait_timeout=0.05)
+        hung = buffer._open = _Batch()
+        hung.rows = events(1)
+        # the leader took the batch (rows 1-3 included) and its insert hangs
+        original_leave = buffer._leave
+
+        def leave_after_flush_started(batch, rows):
+            batch.flushing = True
+            return original_leave(batch, rows)
+
+        buffer._leave = leave_after_flush_started
+        with self.assertRaises(WebhookIngestError):
+            buffer.submit(events(2, 3))
+        # nothing inserted twice: the rows stay with the hung batch
+        self.assertEqual(stored_ids(), [])
+        self.assertEqual(len(hung.rows), 3)
+
+
+class WebhookIngestConcurrencyTests(TransactionTestCase):
+    def test_leader_waiting_for_another_flush(self):
+        buffer = WebhookIngestBuffer(max_wait=0.0, wait_timeout=0.05)
+
+        def leader():
+            try:
+                buffer.submit(events(1))
+            finally:
+                connection.close()
+
+        # another flush is in progress: the leader waits for it with its batch open
+        buffer._flush_lock.acquire()
+        thread = threading.Thread(target=leader)
+        thread.start()
+        while buffer._open is None:
+            pass
+        try:
+            buffer.submit(events(2))
+            self.assertEqual(stored_ids(), [2])
+        finally:
+            buffer._flush_lock.release()
+            thread.join()
+        self.assertEqual(stored_ids(), [1, 2])
+
+    @requires_postgres
+    def test_concurrent_submits_are_stored_once(self):
+        buffer = WebhookIngestBuffer(max_wait=0.01)
+        start = threading.Barrier(8)
+        stored = []
+
+        def client(n):
+            try:
+                start.wait()
+                stored.append(buffer.submit(events(2 * n, 2 * n + 1)))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=client, args=(n,)) for n in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(stored, [2] * 8)
+        self.assertEqual(stored_ids(), list(range(16)))
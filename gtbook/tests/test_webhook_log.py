@@ -0,0 +1,34 @@
+from datetime import timedelta
+
+from django.test import TestCase
+from django.utils import timezone
+
+from gtbook.models import WebhookLog
+
+
+class WebhookLogTrimTests(TestCase):
+    def add_entries(self, count, timestamp):
+        WebhookLog.objects.bulk_create(WebhookLog(webhook_id=i, message="ok") for i in range(count))
+        # auto_now_add ignores explicit values on insert
+        WebhookLog.objects.filter(timestamp__gt=timestamp).update(timestamp=timestamp)
+
+    def test_max_entries_with_equal_timestamps(self):
+        now = timezone.now()
+        self.add_entries(10, now)
+        WebhookLog.trim(max_entries=4, max_age=timedelta(days=365))
+        # the newest four (highest ids) survive, ties or not
+        self.assertEqual(
+            list(WebhookLog.objects.order_by("id").values_list("webhook_id", flat=True)), [6, 7, 8, 9],
+        )
+
+    def test_max_entries_across_timestamps(self):
+        self.add_entries(3, timezone.now() - timedelta(hours=2))
+        self.add_entries(3, timezone.now() - timedelta(hours=1))
+        WebhookLog.trim(max_entries=4, max_age=timedelta(days=365))
+        self.assertEqual(WebhookLog.objects.count(), 4)
+
+    def test_max_age(self):
+        self.add_entries(2, timezone.now() - timedelta(days=40))
+        self.add_entries(3, timezone.now())
+        WebhookLog.trim(max_entries=0, max_age=timedelta(days=30))
+        self.assertEqual(WebhookLog.objects.count(), 3)
@@ -0,0 +1,130 @@
+import threading
+from unittest import mock
+
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, TransactionTestCase
+
+from gtbook.models import Dokumenti, Klijenti, WebhookEvent, WebhookLog
+from gtbook.tests import requires_postgres
+from gtbook.utils import webhook_processing, webhook_worker
+from gtbook.utils.webhook_worker import claim_batch, process_pending, run_batch
+
+SEF_ID = "1234567"
+
+
+class StaleEventTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        klijent = Klijenti.objects.create(ime="Kupac", pib="100000001", mbr="10000001", adresa="-")
+        # file attached: processing needs no SEF download
+        cls.doc = Dokumenti.objects.create(
+            klijent=klijent, dok_tip="IZF", dok_br="260001", salesInvoiceId=SEF_ID,
+            status_SEF="SLA", file="blobs/00/00/invoice.xml",
+        )
+
+    def event(self, status):
+        return WebhookEvent.objects.create(
+            type="izlazne", payload={"SalesInvoiceId": int(SEF_ID), "NewInvoiceStatus": status},
+        )
+
+    def status(self):
+        self.doc.refresh_from_db()
+        return self.doc.status_SEF
+
+    def test_retry_after_newer_event_is_skipped(self):
+        sent, approved = self.event("Sent"), self.event("Approved")
+
+        # "Sent" fails and is scheduled for a retry
+        with mock.patch.object(webhook_worker, "process_invoice_event", side_effect=OSError("disk full")):
+            self.assertEqual(run_batch([sent.id]), [(sent.id, False, mock.ANY)])
+        sent.refresh_from_db()
+        self.assertEqual(sent.attempts, 1)
+
+        # "Approved" for the same invoice succeeds in the meantime
+        self.assertEqual(run_batch([approved.id]), [(approved.id, True, None)])
+        self.assertEqual(self.status(), "PRI")
+
+        # the retry succeeds without setting the invoice back to POS
+        self.assertEqual(run_batch([sent.id]), [(sent.id, True, None)])
+        self.assertEqual(self.status(), "PRI")
+        self.assertEqual(self.doc.sef_event_id, approved.id)
+        self.assertFalse(WebhookEvent.objects.exists())
+        self.assertEqual(WebhookLog.objects.count(), 1)
+
+    def test_newer_event_still_applies(self):
+        sent, approved = self.event("Sent"), self.event("Approved")
+        run_batch([sent.id])
+        self.assertEqual(self.status(), "POS")
+        run_batch([approved.id])
+        self.assertEqual(self.status(), "PRI")
+
+    def test_superseded_event_needs_no_download(self):
+        sent, approved = self.event("Sent"), self.event("Approved")
+        run_batch([approved.id])
+        # the leased-out "Sent" finishes later, for an invoice without its XML
+        Dokumenti.objects.filter(pk=self.doc.pk).update(file="")
+        with mock.patch.object(webhook_processing, "download_invoice_xml", side_effect=AssertionError("downloaded")):
+            self.assertEqual(run_batch([sent.id]), [(sent.id, True, None)])
+        self.assertEqual(self.status(), "PRI")
+        self.assertFalse(WebhookEvent.objects.exists())
+
+
+class ReleaseConnectionsTests(SimpleTestCase):
+    def test_pools_are_closed_before_forking(self):
+        pooled, plain = mock.Mock(), mock.Mock(spec=["close"])
+        with mock.patch.object(webhook_worker, "connections") as connections:
+            connections.all.return_value = [pooled, plain]
+            webhook_worker._release_connections()
+        connections.close_all.assert_called_once_with()
+        connections.all.assert_called_once_with(initialized_only=True)
+        pooled.close_pool.assert_called_once_with()
+
+
+@requires_postgres
+class WorkerConcurrencyTests(TransactionTestCase):
+    INVOICES = 20
+
+    def setUp(self):
+        klijent = Klijenti.objects.create(ime="Kupac", pib="100000001", mbr="10000001", adresa="-")
+        Dokumenti.objects.bulk_create(
+            Dokumenti(
+                klijent=klijent, dok_tip="IZF", dok_br=f"26{n:04}", salesInvoiceId=str(1000 + n),
+                status_SEF="SLA", file="blobs/00/00/invoice.xml",
+            )
+            for n in range(self.INVOICES)
+        )
+        self.ids = [
+            event.id for event in WebhookEvent.objects.bulk_create(
+                WebhookEvent(type="izlazne", payload={"SalesInvoiceId": 1000 + n, "NewInvoiceStatus": "Approved"})
+                for n in range(self.INVOICES)
+            )
+        ]
+
+    def test_concurrent_claims_are_disjoint(self):
+        claimed = []
+
+        def worker(name):
+            try:
+                while ids := claim_batch(name, 3):
+                    claimed.extend(ids)
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=worker, args=(f"w{n}",)) for n in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(claimed), sorted(self.ids))
+
+    def assert_processed(self, mode):
+        self.assertEqual(process_pending(workers=3, mode=mode, batch_size=7), (self.INVOICES, 0))
+        # the parent still has a working connection (and pool) afterwards
+        self.assertFalse(WebhookEvent.objects.exists())
+        self.assertEqual(Dokumenti.objects.filter(status_SEF="PRI").count(), self.INVOICES)
+
+    def test_thread_pool(self):
+        self.assert_processed("thread")
+
+    def test_process_pool(self):
+        self.assert_processed("process")
@@ -0,0 +1,173 @@
+import base64
+import gzip
+import io
+import os
+import tempfile
+from unittest import mock, skipIf
+
+from django.test import SimpleTestCase
+
+from gtbook.utils import faktura_xml_extract
+from gtbook.utils.faktura_xml_extract import LET, extract_full_invoice
+
+# not a real PDF — any bytes do, as long as the payload spans several chunks
+PDF = b"%PDF-1.7\n" + bytes(range(256)) * 400
+
+PAYLOAD = base64.encodebytes(PDF).decode()
+
+
+def envelope(payload):
+    return f"""<?xml version="1.0" encoding="utf-8"?>
+<!-- SEF envelope -->
+<env:DocumentEnvelope xmlns:env="urn:eFaktura:MinFinrs:envelop:schema">
+  <env:DocumentHeader>
+    <env:SalesInvoiceId>1234567</env:SalesInvoiceId>
+    <env:PurchaseInvoiceId>7654321</env:PurchaseInvoiceId>
+    <env:DocumentId>0f1e2d3c-4b5a-6978-8796-a5b4c3d2e1f0</env:DocumentId>
+    <env:CreationDate>2026-03-01</env:CreationDate>
+    <env:SendingDate>2026-03-02</env:SendingDate>
+    <env:DocumentPdf mimeCode="application/pdf">
+{payload}    </env:DocumentPdf>
+  </env:DocumentHeader>
+  <env:DocumentBody>
+    <Invoice xmlns="urn:oasis:names:specification:ubl:schema:xsd:Invoice-2"
+             xmlns:cac="urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+             xmlns:cbc="urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2">
+      <cbc:CustomizationID>urn:cen.eu:en16931:2017#compliant#urn:mfin.gov.rs:srbdt:2022</cbc:CustomizationID>
+      <cbc:ID>26-0042</cbc:ID>
+      <cbc:IssueDate>2026-03-01</cbc:IssueDate>
+      <cbc:DueDate>2026-03-16</cbc:DueDate>
+      <cbc:InvoiceTypeCode>380</cbc:InvoiceTypeCode>
+      <cbc:Note>Napomena &amp; opis</cbc:Note>
+      <cbc:DocumentCurrencyCode>RSD</cbc:DocumentCurrencyCode>
+      <cac:AccountingSupplierParty>
+        <cac:Party>
+          <cac:PartyName><cbc:Name>Dobavljač d.o.o.</cbc:Name></cac:PartyName>
+          <cac:PostalAddress><cbc:StreetName>Glavna 1</cbc:StreetName></cac:PostalAddress>
+          <cac:PartyTaxScheme><cbc:CompanyID>RS100000001</cbc:CompanyID></cac:PartyTaxScheme>
+          <cac:PartyLegalEntity><cbc:CompanyID>10000001</cbc:CompanyID></cac:PartyLegalEntity>
+          <cac:Contact><cbc:ElectronicMail>prodaja@dobavljac.rs</cbc:ElectronicMail></cac:Contact>
+        </cac:Party>
+      </cac:AccountingSupplierParty>
+      <cac:AccountingCustomerParty>
+        <cac:Party>
+          <cac:PartyName><cbc:Name>Kupac</cbc:Name></cac:PartyName>
+          <cac:PartyTaxScheme><cbc:CompanyID>RS100000002</cbc:CompanyID></cac:PartyTaxScheme>
+          <cac:Contact><cbc:ElectronicMail>nabavka@kupac.rs</cbc:ElectronicMail></cac:Contact>
+        </cac:Party>
+      </cac:AccountingCustomerParty>
+      <cac:Delivery><cbc:ActualDeliveryDate>2026-02-28</cbc:ActualDeliveryDate></cac:Delivery>
+      <cac:LegalMonetaryTotal>
+        <cbc:LineExtensionAmount currencyID="RSD">1500.00</cbc:LineExtensionAmount>
+        <cbc:TaxExclusiveAmount currencyID="RSD">1500.00</cbc:TaxExclusiveAmount>
+        <cbc:TaxInclusiveAmount currencyID="RSD">1500.00</cbc:TaxInclusiveAmount>
+        <cbc:PayableAmount currencyID="RSD">1500.00</cbc:PayableAmount>
+      </cac:LegalMonetaryTotal>
+      <cac:InvoiceLine>
+        <cbc:ID>1</cbc:ID>
+        <cbc:InvoicedQuantity unitCode="HUR">2.5</cbc:InvoicedQuantity>
+        <cbc:LineExtensionAmount currencyID="RSD">1000.00</cbc:LineExtensionAmount>
+        <cac:Item><cbc:Name>Konsultacije</cbc:Name></cac:Item>
+        <cac:Price><cbc:PriceAmount currencyID="RSD">400.00</cbc:PriceAmount></cac:Price>
+      </cac:InvoiceLine>
+      <cac:InvoiceLine>
+        <cbc:ID>2</cbc:ID>
+        <cbc:InvoicedQuantity unitCode="H87">1</cbc:InvoicedQuantity>
+        <cbc:LineExtensionAmount currencyID="RSD">500.00</cbc:LineExtensionAmount>
+        <cac:Item><cbc:Name>Kabl</cbc:Name></cac:Item>
+        <cac:Price><cbc:PriceAmount currencyID="RSD">500.00</cbc:PriceAmount></cac:Price>
+      </cac:InvoiceLine>
+    </Invoice>
+  </env:DocumentBody>
+</env:DocumentEnvelope>
+""".encode()
+
+
+ENVELOPE = envelope(PAYLOAD)
+
+# the same PDF written the other ways XML allows; ElementTree decodes them all
+half = len(PAYLOAD) // 2
+PAYLOAD_VARIANTS = {
+    "charrefs": PAYLOAD.replace("\n", "&#13;&#10;").replace("+", "&#43;", 3).replace("/", "&#x2F;", 3),
+    "cdata": f"<![CDATA[{PAYLOAD}]]>",
+    "mixed": f"{PAYLOAD[:half]}<!-- split -->&#x0A;<![CDATA[{PAYLOAD[half:]}]]>\n<?pi x?>",
+}
+
+BACKENDS = ["etree"] + (["lxml"] if LET is not None else [])
+# 1 and 7 split every tag and base64 quantum; the default reads it in one go
+CHUNK_SIZES = [1, 7, faktura_xml_extract.CHUNK_SIZE]
+
+
+class ExtractFullInvoiceTests(SimpleTestCase):
+    def setUp(self):
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.tmp = tmp.name
+
+    def extract(self, data, backend, chunk_size=faktura_xml_extract.CHUNK_SIZE):
+        output_pdf = os.path.join(self.tmp, f"{backend}-{chunk_size}.pdf")
+        with mock.patch.object(faktura_xml_extract, "CHUNK_SIZE", chunk_size):
+            result = extract_full_invoice(io.BytesIO(data), output_pdf, backend=backend)
+        with open(output_pdf, "rb") as f:
+            return result, f.read()
+
+    def test_fixture_fields(self):
+        data, pdf = self.extract(ENVELOPE, "etree")
+        self.assertEqual(pdf, PDF)
+        self.assertEqual(data["header"]["SalesInvoiceId"], "1234567")
+        self.assertEqual(data["header"]["DocumentPdfSavedAs"], os.path.join(self.tmp, f"etree-{faktura_xml_extract.CHUNK_SIZE}.pdf"))
+        self.assertEqual(data["invoice"]["Note"], "Napomena & opis")
+        self.assertEqual(data["invoice"]["Supplier"]["PIB"], "RS100000001")
+        self.assertEqual(data["invoice"]["PayableAmount"], "1500.00")
+        self.assertEqual(
+            data["lines"][0],
+            {"ID": "1", "InvoicedQuantity": "2.5", "UnitCode": "HUR", "LineExtensionAmount": "1000.00",
+             "ItemName": "Konsultacije", "PriceAmount": "400.00"},
+        )
+        self.assertEqual(len(data["lines"]), 2)
+
+    def test_backends_and_chunk_sizes_agree(self):
+        expected, _ = self.extract(ENVELOPE, "etree")
+        del expected["header"]["DocumentPdfSavedAs"]
+        for backend in BACKENDS:
+            for chunk_size in CHUNK_SIZES:
+                with self.subTest(backend=backend, chunk_size=chunk_size):
+                    data, pdf = self.extract(ENVELOPE, backend, chunk_size)
+                    self.assertEqual(pdf, PDF)
+                    self.assertTrue(data["header"].pop("DocumentPdfSavedAs").endswith(f"{backend}-{chunk_size}.pdf"))
+                    self.assertEqual(data, expected)
+
+    def test_payload_variants(self):
+        expected, _ = self.extract(ENVELOPE, "etree")
+        del expected["header"]["DocumentPdfSavedAs"]
+        for name, payload in PAYLOAD_VARIANTS.items():
+            for backend in BACKENDS:
+                for chunk_size in CHUNK_SIZES:
+                    with self.subTest(payload=name, backend=backend, chunk_size=chunk_size):
+                        data, pdf = self.extract(envelope(payload), backend, chunk_size)
+                        self.assertEqual(pdf, PDF)
+                        self.assertIn("DocumentPdfSavedAs", data["header"])
+                        del data["header"]["DocumentPdfSavedAs"]
+                        self.assertEqual(data, expected)
+
+    def test_gzip_input(self):
+        expected, _ = self.extract(ENVELOPE, "etree")
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                data, pdf = self.extract(gzip.compress(ENVELOPE), backend)
+                self.assertEqual(pdf, PDF)
+                self.assertEqual(data["invoice"], expected["invoice"])
+                self.assertEqual(data["lines"], expected["lines"])
+
+    def test_without_output_pdf(self):
+        for backend in BACKENDS:
+            with self.subTest(backend=backend):
+                data = extract_full_invoice(io.BytesIO(ENVELOPE), backend=backend)
+                self.assertNotIn("DocumentPdfSavedAs", data["header"])
+                self.assertNotIn("DocumentPdf", data["header"])
+                self.assertEqual(data["invoice"]["ID"], "26-0042")
+
+    @skipIf(LET is not None, "lxml is installed")
+    def test_lxml_missing(self):
+        with self.assertRaises(ValueError):
+            extract_full_invoice(io.BytesIO(ENVELOPE), backend="lxml")
@@ -19,12 +19,14 @@ urlpatterns = [
 
     # Dokumenti
     path('dokumenti/', views.dokument_list, name='dokument_list'),
+    path('dokumenti/data/', views.dokument_list_data, name='dokument_list_data'),
     path('nova/<str:tip>/', views.dokument_create, name='dokument_create'),
     path('nova-blanko/<str:tip>/', views.dokument_create_empty, name='dokument_create_empty'),
     path('izmena/<int:pk>/', views.dokument_edit, name='dokument_edit'),
     path('brisanje/<int:pk>/', views.dokument_delete, name='dokument_delete'),
     path("dokument/<int:pk>/storno/", views.dokument_storno_view, name="dokument_storno"),
     path("dokument/<int:pk>/details/", views.dokument_details, name="dokument_details"),
+    path("dokument/<int:pk>/fajl/", views.dokument_file, name="dokument_file"),
 
     path('izf/<int:izf_id>/otp/<int:otp_id>/unlink/', views.unlink_otp_from_izf, name='unlink_otp_from_izf'),
     path("izf/<int:izf_id>/otp/<int:otp_id>/link/", views.link_otp_to_izf, name="link_otp_to_izf"),
@@ -51,7 +53,7 @@ urlpatterns = [
     path("reports/faktura/pdf/<int:doc_id>/", views.faktura_pdf, name="faktura_pdf"),
 ]
 
-def health(request):
+async def health(request):
     return HttpResponse("OK")
 
 urlpatterns += [
@@ -0,0 +1,173 @@
+# gtbook/utils/blob_store.py
+import gzip
+import hashlib
+import os
+import shutil
+from pathlib import PurePath
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.core.files import File
+from django.core.files.storage import FileSystemStorage
+from django.utils.deconstruct import deconstructible
+
+try:
+    import zstandard
+except ImportError:  # optional, only needed for ATTACHMENT_COMPRESSION=zstd
+    zstandard = None
+
+BLOB_PREFIX = "blobs"
+HASH_CHUNK = 1024 * 1024
+
+# compression: suffix appended to the blob name
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "zstd": ".zst"}
+# SEF XMLs embed a base64 PDF and shrink a lot; PDFs themselves don't
+COMPRESSIBLE = (".xml",)
+GZIP_LEVEL = 6
+ZSTD_LEVEL = 10
+
+
+def blob_name(digest, suffix=""):
+    """blobs/ab/cd/<sha256><suffix> — two fan-out levels keep directories small."""
+    return f"{BLOB_PREFIX}/{digest[:2]}/{digest[2:4]}/{digest}{suffix.lower()}"
+
+
+def is_blob(name):
+    return bool(name) and name.startswith(BLOB_PREFIX + "/")
+
+
+def compression_of(name):
+    """The compression a stored file name carries, or None."""
+    for compression, suffix in COMPRESSION_SUFFIXES.items():
+        if name.endswith(suffix):
+            return compression
+    return None
+
+
+def _open_compressed(path, mode, compression):
+    if compression == "gzip":
+        return gzip.open(path, mode, compresslevel=GZIP_LEVEL) if "w" in mode else gzip.open(path, mode)
+    if zstandard is None:
+        raise ImproperlyConfigured("zstd compression requires the 'zstandard' package")
+    if "w" in mode:
+        return zstandard.open(path, mode, cctx=zstandard.ZstdCompressor(level=ZSTD_LEVEL))
+    return zstandard.open(path, mode)
+
+
+@deconstructible
+class ContentAddressedStorage(FileSystemStorage):
+    """
+    FileSystemStorage that keeps every file under the SHA-256 of its content.
+    Saving content that is already stored returns the existing name, so the
+    same SEF XML (or PDF) takes disk space once however often it arrives.
+    The requested name only contributes its extension. Files saved under
+    other names before (documents/%Y/%m/%d/...) are still served as-is.
+
+    With ATTACHMENT_COMPRESSION ("gzip" or "zstd") XMLs are stored compressed
+    (<sha256>.xml.gz / .xml.zst, hashed before compression) and open() hands
+    back the decompressed stream, so readers never notice. size() reports
+    the size on disk.
+
+    Blobs may be shared by several documents: never delete one through a
+    single FieldFile — orphans are removed by `manage.py gc_media`.
+    """
+
+    def _existing(self, target):
+        for name in (target, *(target + suffix for suffix in COMPRESSION_SUFFIXES.values())):
+            if self.exists(name):
+                return name
+        return None
+
+    def _compression_for(self, name, compression=None):
+        compression = compression or settings.ATTACHMENT_COMPRESSION
+        if not compression or PurePath(name).suffix.lower() not in COMPRESSIBLE:
+            return None
+        if compression not in COMPRESSION_SUFFIXES:
+            raise ImproperlyConfigured(f"Unknown ATTACHMENT_COMPRESSION: {compression}")
+        return compression
+
+    def _save_compressed(self, name, f, compression):
+        """Write file object `f` compressed under `name` + suffix; returns that name."""
+        name += COMPRESSION_SUFFIXES[compression]
+        full_path = self.path(name)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+        part_path = full_path + ".part"
+        with _open_compressed(part_path, "wb", compression) as out:
+            shutil.copyfileobj(f, out, HASH_CHUNK)
+        if self.file_permissions_mode is not None:
+            os.chmod(part_path, self.file_permissions_mode)
+        os.replace(part_path, full_path)
+        return name
+
+    def _open(self, name, mode="rb"):
+        compression = compression_of(name)
+        if compression is None:
+            return super()._open(name, mode)
+        return File(_open_compressed(self.path(name), mode, compression), name)
+
+    def save(self, name, content, max_length=None):
+        if not hasattr(content, "chunks"):
+            content = File(content, name)
+        digest = hashlib.sha256()
+        for chunk in content.chunks(HASH_CHUNK):
+            digest.update(chunk)
+        target = blob_name(digest.hexdigest(), PurePath(name).suffix)
+        existing = self._existing(target)
+        if existing:
+            return existing
+        content.seek(0)
+        compression = self._compression_for(target)
+        if compression:
+            return self._save_compressed(target, content, compression)
+        return super().save(target, content, max_length=max_length)
+
+    def save_local(self, path, compression=None, link=False):
+        """
+        Store a file from the local filesystem and return the blob name. The
+        source file is left alone. It is copied unless `link` is set: then it
+        is hard-linked into the blob tree when on the same filesystem (no data
+        copied). Link only files the app owns and never rewrites in place
+        (sef_tmp downloads, old media files): a linked source edited later
+        would change the blob under its SHA-256 name.
+        """
+        with open(path, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        target = blob_name(digest, PurePath(path).suffix)
+        existing = self._existing(target)
+        if existing:
+            return existing
+
+        compression = self._compression_for(target, compression)
+        if compression:
+            with open(path, "rb") as f:
+                return self._save_compressed(target, f, compression)
+
+        if link:
+            full_path = self.path(target)
+            os.makedirs(os.path.dirname(full_path), exist_ok=True)
+            try:
+                os.link(path, full_path)
+                return target
+            except FileExistsError:
+                return target  # stored concurrently — same content by definition
+            except OSError:
+                pass  # other filesystem (or no hard links): copy instead
+        with open(path, "rb") as f:
+            return super().save(target, File(f), max_length=None)
+
+    def compress(self, name, compression):
+        """
+        Store the (uncompressed) file `name` compressed as a blob and return
+        the new name. Already compressed files and non-XMLs keep their name.
+        The old file is not removed — it may still be referenced.
+        """
+        if compression_of(name) or not self._compression_for(name, compression):
+            return name
+        with open(self.path(name), "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+            target = blob_name(digest, PurePath(name).suffix)
+            compressed = target + COMPRESSION_SUFFIXES[compression]
+            if self.exists(compressed):
+                return compressed
+            f.seek(0)
+            return self._save_compressed(target, f, compression)
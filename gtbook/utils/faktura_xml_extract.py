@@ -1,113 +1,450 @@
 import base64
+import gzip
+import logging
+import re
 import xml.etree.ElementTree as ET
+from contextlib import ExitStack, contextmanager
+
+try:
+    from lxml import etree as LET
+except ImportError:  # optional, stdlib ElementTree is the fallback
+    LET = None
+
+try:
+    import zstandard
+except ImportError:  # optional, for zstd-compressed attachments
+    zstandard = None
+
+from gtbook.utils.log import log_event, log_stage
+
+logger = logging.getLogger(__name__)
 
 # myxml_file = "base64.xml"
 # myoutput_pdf = "invoice.pdf"
 
-def extract_full_invoice(xml_file, output_pdf=None):
-    tree = ET.parse(xml_file)
-    root = tree.getroot()
+CHUNK_SIZE = 64 * 1024
+PDF_TAG = "{urn:eFaktura:MinFinrs:envelop:schema}DocumentPdf"
+DEFAULT_BACKEND = "lxml" if LET is not None else "etree"
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
 
-    # Namespaces
-    ns = {
-        "env": "urn:eFaktura:MinFinrs:envelop:schema",
-        "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
-        "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
-    }
 
+class _Base64Sink:
+    """Decode base64 text arriving in arbitrary pieces straight into a file."""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+        self.parts = []
+        self.buffered = 0
+        self.pending = ""
+
+    def write(self, text):
+        # expat hands over the payload line by line — decode in larger blocks
+        self.parts.append(text)
+        self.buffered += len(text)
+        if self.buffered >= CHUNK_SIZE:
+            self._decode()
+
+    def _decode(self, final=False):
+        data = self.pending + "".join("".join(self.parts).split())
+        self.parts = []
+        self.buffered = 0
+        cut = len(data) if final else len(data) - len(data) % 4   # whole 4-char quanta
+        self.pending = data[cut:]
+        if cut:
+            if self.file is None:
+                self.file = open(self.path, "wb")
+            self.file.write(base64.b64decode(data[:cut]))
+
+    def close(self):
+        """Flush and close; returns True if a PDF was written."""
+        try:
+            self._decode(final=True)
+        finally:
+            if self.file is not None:
+                self.file.close()
+        return self.file is not None
+
+
+class _EnvelopeTarget:
+    """
+    Parser target that builds the envelope tree except for the DocumentPdf
+    text: that is never accumulated, only streamed to `pdf_sink` (or dropped
+    when there is no sink). Memory stays flat however large the PDF is.
+    """
+
+    def __init__(self, builder, pdf_sink=None):
+        self.builder = builder
+        self.pdf_sink = pdf_sink
+        self.in_pdf = False
+
+    def start(self, tag, attrib):
+        if tag == PDF_TAG:
+            self.in_pdf = True
+        return self.builder.start(tag, attrib)
+
+    def end(self, tag):
+        if tag == PDF_TAG:
+            self.in_pdf = False
+        return self.builder.end(tag)
+
+    def data(self, text):
+        if not self.in_pdf:
+            self.builder.data(text)
+        elif self.pdf_sink is not None:
+            self.pdf_sink.write(text)
+
+    def close(self):
+        return self.builder.close()
+
+
+_PDF_START = re.compile(rb"<(?:[\w.-]+:)?DocumentPdf\b[^>]*>")
+_TEXT_MARKUP = re.compile(rb"[<&]")
+# markup allowed inside the payload: (start, end, its content is text)
+_PDF_MARKUP = ((b"<![CDATA[", b"]]>", True), (b"<!--", b"-->", False), (b"<?", b"?>", False))
+_ENTITIES = {b"amp": "&", b"lt": "<", b"gt": ">", b"quot": '"', b"apos": "'"}
+# longest reference worth waiting for: &#x10FFFF;
+_MAX_REFERENCE = 10
+
+
+def _decode_reference(name):
+    """Text of the XML reference &name; (character or predefined entity)."""
+    if name.startswith(b"#x"):
+        return chr(int(name[2:], 16))
+    if name.startswith(b"#"):
+        return chr(int(name[1:]))
+    if name in _ENTITIES:
+        return _ENTITIES[name]
+    raise ValueError(f"Unsupported entity in DocumentPdf: &{name.decode('latin-1')};")
+
+
+class _PdfSplitter:
+    """
+    Byte-level feed filter for the lxml backend: the DocumentPdf payload is
+    cut out of the stream before it reaches the parser and handed to
+    `pdf_sink`, so lxml builds the tree natively (no per-event Python
+    callbacks) and memory stays flat. Within the payload, character and
+    entity references are decoded, CDATA sections are passed on as text and
+    comments/PIs are dropped — what ElementTree would hand to _EnvelopeTarget.
+    The payload ends at the first other markup (the end tag). Assumes an
+    ASCII-compatible encoding (SEF: UTF-8).
+    """
+
+    def __init__(self, parser, pdf_sink=None):
+        self.parser = parser
+        self.pdf_sink = pdf_sink
+        self.in_pdf = False
+        self.done = False
+        self.markup = None  # (end, is_text) while inside CDATA/comment/PI
+        self.tail = b""
+
+    def _write(self, payload):
+        if payload and self.pdf_sink is not None:
+            self.pdf_sink.write(payload if isinstance(payload, str) else payload.decode("latin-1"))
+
+    def feed(self, chunk):
+        data = self.tail + chunk
+        self.tail = b""
+        while data:
+            if self.done:
+                self.parser.feed(data)
+                return
+            if self.in_pdf:
+                data = self._feed_payload(data)
+                continue
+            match = _PDF_START.search(data)
+            if match is None:
+                # hold back a start tag that may continue in the next chunk
+                cut = data.rfind(b"<")
+                if cut < 0 or data.find(b">", cut) >= 0:
+                    cut = len(data)
+                self.parser.feed(data[:cut])
+                self.tail = data[cut:]
+                return
+            self.parser.feed(data[:match.end()])
+            data = data[match.end():]
+            if match.group().endswith(b"/>"):
+                self.done = True
+            else:
+                self.in_pdf = True
+
+    def _feed_payload(self, data):
+        """Consume payload from `data`; returns what is left to process."""
+        if self.markup is not None:
+            end, is_text = self.markup
+            found = data.find(end)
+            if found < 0:
+                # keep what may be the start of `end`
+                keep = min(len(data), len(end) - 1)
+                if is_text:
+                    self._write(data[:len(data) - keep])
+                self.tail = data[len(data) - keep:]
+                return b""
+            if is_text:
+                self._write(data[:found])
+            self.markup = None
+            return data[found + len(end):]
+
+        match = _TEXT_MARKUP.search(data)
+        if match is None:
+            self._write(data)
+            return b""
+        self._write(data[:match.start()])
+        data = data[match.start():]
+
+        if data.startswith(b"&"):
+            semi = data.find(b";")
+            if semi < 0:
+                if len(data) > _MAX_REFERENCE:
+                    raise ValueError("Malformed reference in DocumentPdf")
+                self.tail = data
+                return b""
+            self._write(_decode_reference(data[1:semi]))
+            return data[semi + 1:]
+
+        for start, end, is_text in _PDF_MARKUP:
+            if data.startswith(start):
+                self.markup = (end, is_text)
+                return data[len(start):]
+            if start.startswith(data):
+                # too short to tell yet
+                self.tail = data
+                return b""
+        # the end tag: hand the rest to the parser
+        self.in_pdf = False
+        self.done = True
+        return data
+
+    def close(self):
+        if self.tail:
+            self.parser.feed(self.tail)
+        return self.parser.close()
+
+
+@contextmanager
+def _open_source(xml_file):
+    """
+    Binary stream of the envelope (path or file object). Attachments stored
+    gzip/zstd-compressed are recognised by their magic bytes and decompressed
+    on the fly.
+    """
+    with ExitStack() as stack:
+        f = xml_file if hasattr(xml_file, "read") else stack.enter_context(open(xml_file, "rb"))
+        magic = b""
+        if f.seekable():
+            position = f.tell()
+            magic = f.read(4)
+            f.seek(position)
+        if magic.startswith(GZIP_MAGIC):
+            f = stack.enter_context(gzip.GzipFile(fileobj=f))
+        elif magic.startswith(ZSTD_MAGIC):
+            if zstandard is None:
+                raise ValueError("zstd-compressed XML requires the 'zstandard' package")
+            f = stack.enter_context(zstandard.ZstdDecompressor().stream_reader(f, closefd=False))
+        yield f
+
+
+def _parse_envelope(xml_file, output_pdf=None, backend="etree"):
+    """
+    Incrementally parse a SEF envelope (path or binary file object).
+    Returns (root, pdf_saved).
+    """
+    sink = _Base64Sink(output_pdf) if output_pdf else None
+    if backend == "lxml":
+        # comments/PIs dropped to match ElementTree's TreeBuilder
+        parser = _PdfSplitter(LET.XMLParser(
+            resolve_entities=False, no_network=True,
+            remove_comments=True, remove_pis=True,
+        ), sink)
+    else:
+        parser = ET.XMLParser(target=_EnvelopeTarget(ET.TreeBuilder(), sink))
+
+    try:
+        with _open_source(xml_file) as f:
+            for chunk in iter(lambda: f.read(CHUNK_SIZE), b""):
+                parser.feed(chunk)
+        root = parser.close()
+    finally:
+        pdf_saved = sink.close() if sink else False
+    return root, pdf_saved
+
+
+# Namespaces
+NS = {
+    "env": "urn:eFaktura:MinFinrs:envelop:schema",
+    "inv": "urn:oasis:names:specification:ubl:schema:xsd:Invoice-2",
+    "cbc": "urn:oasis:names:specification:ubl:schema:xsd:CommonBasicComponents-2",
+    "cac": "urn:oasis:names:specification:ubl:schema:xsd:CommonAggregateComponents-2"
+}
+
+INVOICE_FIELDS = ["CustomizationID", "ID", "IssueDate", "DueDate",
+                  "InvoiceTypeCode", "Note", "DocumentCurrencyCode"]
+TOTAL_FIELDS = ["LineExtensionAmount", "TaxExclusiveAmount", "TaxInclusiveAmount",
+                "AllowanceTotalAmount", "PrepaidAmount", "PayableRoundingAmount", "PayableAmount"]
+LINE_FIELDS = ["ID", "InvoicedQuantity", "LineExtensionAmount"]
+
+# Every path _extract() looks up; the lxml backend compiles them once.
+PATHS = [
+    ".//env:DocumentHeader",
+    ".//inv:Invoice",
+    "cac:AccountingSupplierParty/cac:Party",
+    "cac:AccountingCustomerParty/cac:Party",
+    "cac:PartyName/cbc:Name",
+    "cac:PostalAddress/cbc:StreetName",
+    "cac:Contact/cbc:ElectronicMail",
+    "cac:PartyTaxScheme/cbc:CompanyID",
+    "cac:PartyLegalEntity/cbc:CompanyID",
+    "cac:Delivery/cbc:ActualDeliveryDate",
+    "cac:LegalMonetaryTotal",
+    "cac:InvoiceLine",
+    "cac:Item/cbc:Name",
+    "cac:Price/cbc:PriceAmount",
+] + [f"cbc:{field}" for field in dict.fromkeys(INVOICE_FIELDS + TOTAL_FIELDS + LINE_FIELDS)]
+
+
+def _etree_findall(element, path):
+    return element.findall(path, NS)
+
+
+def _etree_find(element, path):
+    return element.find(path, NS)
+
+
+if LET is not None:
+    _XPATHS = {path: LET.XPath(path, namespaces=NS) for path in PATHS}
+
+    def _lxml_findall(element, path):
+        return _XPATHS[path](element)
+
+    def _lxml_find(element, path):
+        found = _XPATHS[path](element)
+        return found[0] if found else None
+
+
+def _extract(root, find, findall, pdf_saved=False, output_pdf=None):
     data = {"header": {}, "invoice": {}, "lines": []}
 
     # 1️⃣ DocumentHeader
-    header = root.find(".//env:DocumentHeader", ns)
+    header = find(root, ".//env:DocumentHeader")
     if header is not None:
         for child in header:
             tag = child.tag.split("}", 1)[-1]  # remove namespace
             if tag == "DocumentPdf":
-                pdf_b64 = (child.text or "").strip()
-                if pdf_b64:
-                    pdf_bytes = base64.b64decode(pdf_b64)
-                    if output_pdf:
-                        with open(output_pdf, "wb") as f:
-                            f.write(pdf_bytes)
-                        data["header"]["DocumentPdfSavedAs"] = output_pdf
+                # payload was already streamed to output_pdf while parsing
+                if pdf_saved:
+                    data["header"]["DocumentPdfSavedAs"] = output_pdf
             else:
                 data["header"][tag] = (child.text or "").strip()
 
     # 2️⃣ Invoice header and supplier/customer
-    invoice = root.find(".//{urn:oasis:names:specification:ubl:schema:xsd:Invoice-2}Invoice")
+    invoice = find(root, ".//inv:Invoice")
     if invoice is not None:
         # Header fields
-        for field in ["CustomizationID", "ID", "IssueDate", "DueDate", 
-                      "InvoiceTypeCode", "Note", "DocumentCurrencyCode"]:
-            node = invoice.find(f"cbc:{field}", ns)
+        for field in INVOICE_FIELDS:
+            node = find(invoice, f"cbc:{field}")
             if node is not None:
                 data["invoice"][field] = node.text.strip()
 
         # Supplier
-        supplier = invoice.find("cac:AccountingSupplierParty/cac:Party", ns)
+        supplier = find(invoice, "cac:AccountingSupplierParty/cac:Party")
         if supplier is not None:
             supplier_data = {}
-            name_node = supplier.find("cac:PartyName/cbc:Name", ns)
+            name_node = find(supplier, "cac:PartyName/cbc:Name")
             if name_node is not None: supplier_data["Name"] = name_node.text.strip()
-            address_node = supplier.find("cac:PostalAddress/cbc:StreetName", ns)
+            address_node = find(supplier, "cac:PostalAddress/cbc:StreetName")
             if address_node is not None: supplier_data["Address"] = address_node.text.strip()
-            email_node = supplier.find("cac:Contact/cbc:ElectronicMail", ns)
+            email_node = find(supplier, "cac:Contact/cbc:ElectronicMail")
             if email_node is not None: supplier_data["Email"] = email_node.text.strip()
-            company_id = supplier.find("cac:PartyTaxScheme/cbc:CompanyID", ns)
+            company_id = find(supplier, "cac:PartyTaxScheme/cbc:CompanyID")
             if company_id is not None: supplier_data["PIB"] = company_id.text.strip()
-            company_mbr = supplier.find("cac:PartyLegalEntity/cbc:CompanyID", ns)
+            company_mbr = find(supplier, "cac:PartyLegalEntity/cbc:CompanyID")
             if company_mbr is not None: supplier_data["MBR"] = company_mbr.text.strip()
             data["invoice"]["Supplier"] = supplier_data
 
         # Customer
-        customer = invoice.find("cac:AccountingCustomerParty/cac:Party", ns)
+        customer = find(invoice, "cac:AccountingCustomerParty/cac:Party")
         if customer is not None:
             customer_data = {}
-            name_node = customer.find("cac:PartyName/cbc:Name", ns)
+            name_node = find(customer, "cac:PartyName/cbc:Name")
             if name_node is not None: customer_data["Name"] = name_node.text.strip()
-            email_node = customer.find("cac:Contact/cbc:ElectronicMail", ns)
+            email_node = find(customer, "cac:Contact/cbc:ElectronicMail")
             if email_node is not None: customer_data["Email"] = email_node.text.strip()
-            company_id = customer.find("cac:PartyTaxScheme/cbc:CompanyID", ns)
+            company_id = find(customer, "cac:PartyTaxScheme/cbc:CompanyID")
             if company_id is not None: customer_data["CompanyID"] = company_id.text.strip()
             data["invoice"]["Customer"] = customer_data
 
         # Delivery
-        delivery = invoice.find("cac:Delivery/cbc:ActualDeliveryDate", ns)
+        delivery = find(invoice, "cac:Delivery/cbc:ActualDeliveryDate")
         if delivery is not None:
             data["invoice"]["ActualDeliveryDate"] = delivery.text.strip()
 
         # Monetary totals
-        totals = invoice.find("cac:LegalMonetaryTotal", ns)
+        totals = find(invoice, "cac:LegalMonetaryTotal")
         if totals is not None:
-            for t in ["LineExtensionAmount", "TaxExclusiveAmount", "TaxInclusiveAmount", 
-                      "AllowanceTotalAmount", "PrepaidAmount", "PayableRoundingAmount", "PayableAmount"]:
-                node = totals.find(f"cbc:{t}", ns)
+            for t in TOTAL_FIELDS:
+                node = find(totals, f"cbc:{t}")
                 if node is not None:
                     data["invoice"][t] = node.text.strip()
 
         # Invoice lines
-        lines = invoice.findall("cac:InvoiceLine", ns)
+        lines = findall(invoice, "cac:InvoiceLine")
         for line in lines:
             line_data = {}
-            for tag in ["ID", "InvoicedQuantity", "LineExtensionAmount"]:
-                node = line.find(f"cbc:{tag}", ns)
+            for tag in LINE_FIELDS:
+                node = find(line, f"cbc:{tag}")
                 if node is not None:
                     line_data[tag] = node.text.strip()
                     # Also store unit if available
                     if tag == "InvoicedQuantity" and "unitCode" in node.attrib:
                         line_data["UnitCode"] = node.attrib["unitCode"]
             # Item name
-            item_node = line.find("cac:Item/cbc:Name", ns)
+            item_node = find(line, "cac:Item/cbc:Name")
             if item_node is not None:
                 line_data["ItemName"] = item_node.text.strip()
             # Price
-            price_node = line.find("cac:Price/cbc:PriceAmount", ns)
+            price_node = find(line, "cac:Price/cbc:PriceAmount")
             if price_node is not None:
                 line_data["PriceAmount"] = price_node.text.strip()
             data["lines"].append(line_data)
-            print(data)
+
     return data
 
+
+def extract_full_invoice(xml_file, output_pdf=None, backend=None):
+    """
+    Parse a SEF envelope into {"header", "invoice", "lines"}.
+    `backend` is "lxml" (compiled XPath; the default when lxml is installed)
+    or "etree" (stdlib). Both return the same dict — pass it explicitly to
+    compare them on real files.
+    """
+    backend = backend or DEFAULT_BACKEND
+    if backend == "lxml":
+        if LET is None:
+            raise ValueError("lxml backend requested but lxml is not installed")
+        find, findall = _lxml_find, _lxml_findall
+    elif backend == "etree":
+        find, findall = _etree_find, _etree_findall
+    else:
+        raise ValueError(f"Unknown XML backend: {backend}")
+
+    with log_stage(logger, "xml.parse", pdf=bool(output_pdf), backend=backend):
+        root, pdf_saved = _parse_envelope(xml_file, output_pdf, backend)
+
+    data = _extract(root, find, findall, pdf_saved, output_pdf)
+    log_event(logger, "xml.extracted", invoice=data["invoice"].get("ID"), lines=len(data["lines"]))
+    return data
+
+def extract_invoice_file(path):
+    """
+    Process-pool entry point for bulk imports: returns (path, data, error)
+    and never raises, so one broken file doesn't abort the whole map().
+    """
+    try:
+        return path, extract_full_invoice(path), None
+    except Exception as e:
+        return path, None, f"{type(e).__name__}: {e}"
+
 # #######################################################################
 # # Usage
 # invoice_data = extract_full_invoice(myxml_file, myoutput_pdf)
@@ -0,0 +1,46 @@
+# gtbook/utils/log.py
+import logging
+import time
+
+
+def _fields(fields):
+    return " ".join(f"{key}={value}" for key, value in fields.items())
+
+
+def log_event(logger, event, level=logging.DEBUG, **fields):
+    """Emit `event` with key=value fields; formatting only happens if enabled."""
+    if logger.isEnabledFor(level):
+        logger.log(level, "event=%s %s", event, _fields(fields), extra={"event": event, "fields": fields})
+
+
+class log_stage:
+    """
+    Time a block and log it at DEBUG as `stage=<name> duration_ms=<ms> k=v...`.
+    When DEBUG is off for `logger` the only cost is one isEnabledFor() check.
+    Extra counters can be added inside the block: `stage.fields["lines"] = 3`.
+    """
+
+    __slots__ = ("logger", "stage", "fields", "start")
+
+    def __init__(self, logger, stage, **fields):
+        self.logger = logger
+        self.stage = stage
+        self.fields = fields
+        self.start = None
+
+    def __enter__(self):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if self.start is None:
+            return False
+        duration_ms = (time.perf_counter() - self.start) * 1000
+        if exc_type is not None:
+            self.fields["error"] = exc_type.__name__
+        self.logger.debug(
+            "stage=%s duration_ms=%.1f %s", self.stage, duration_ms, _fields(self.fields),
+            extra={"stage": self.stage, "duration_ms": duration_ms, "fields": self.fields},
+        )
+        return False
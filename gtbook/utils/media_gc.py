@@ -0,0 +1,136 @@
+# gtbook/utils/media_gc.py
+import os
+import time
+from datetime import timedelta
+from pathlib import Path
+
+from django.conf import settings
+
+from gtbook.models import Dokumenti
+from gtbook.utils.blob_store import BLOB_PREFIX, compression_of, is_blob
+
+
+def _older_than(path, age):
+    return path.stat().st_mtime < time.time() - age.total_seconds()
+
+
+def _attached_sef_ids(invoice_type, sef_ids):
+    field = "purchaseInvoiceId" if invoice_type == "ulazne" else "salesInvoiceId"
+    return set(
+        Dokumenti.objects.filter(**{f"{field}__in": sef_ids})
+        .exclude(file="").exclude(file__isnull=True)
+        .values_list(field, flat=True)
+    )
+
+
+def gc_sef_tmp(min_age=timedelta(hours=1), stale_age=timedelta(days=7), dry_run=False):
+    """
+    Remove leftovers from media/sef_tmp: XMLs whose document already has its
+    file attached, interrupted downloads (*.part) older than `min_age`, and
+    anything older than `stale_age` (retries give up long before that).
+    Returns the removed (or, with dry_run, removable) paths.
+    """
+    base_path = Path(settings.MEDIA_ROOT) / "sef_tmp"
+    if not base_path.is_dir():
+        return []
+
+    removable = []
+    candidates = {"ulazne": {}, "izlazne": {}}
+    for path in base_path.iterdir():
+        if not path.is_file():
+            continue
+        if _older_than(path, stale_age) or (path.suffix == ".part" and _older_than(path, min_age)):
+            removable.append(path)
+        elif path.suffix == ".xml" and _older_than(path, min_age):
+            invoice_type, _, sef_id = path.stem.partition("_")
+            if invoice_type in candidates and sef_id:
+                candidates[invoice_type][sef_id] = path
+
+    for invoice_type, paths in candidates.items():
+        if paths:
+            removable += [paths[sef_id] for sef_id in _attached_sef_ids(invoice_type, list(paths))]
+
+    if not dry_run:
+        for path in removable:
+            path.unlink(missing_ok=True)
+    return removable
+
+
+def gc_blobs(min_age=timedelta(hours=1), dry_run=False):
+    """
+    Remove blobs no Dokumenti.file points to. Blobs younger than `min_age`
+    are kept: their document may still be in an uncommitted transaction.
+    Returns the removed (or removable) blob names.
+    """
+    storage = Dokumenti._meta.get_field("file").storage
+    root = Path(storage.path(BLOB_PREFIX))
+    if not root.is_dir():
+        return []
+
+    referenced = set(
+        Dokumenti.objects.filter(file__startswith=BLOB_PREFIX + "/")
+        .values_list("file", flat=True)
+    )
+    removable = []
+    for dirpath, _, filenames in os.walk(root):
+        for filename in filenames:
+            path = Path(dirpath) / filename
+            name = path.relative_to(storage.location).as_posix()
+            if name not in referenced and _older_than(path, min_age):
+                removable.append(name)
+
+    if not dry_run:
+        for name in removable:
+            storage.delete(name)
+    return removable
+
+
+def migrate_to_blobs(dry_run=False):
+    """
+    Move files saved before the blob store (documents/%Y/%m/%d/...) into it,
+    deduplicating them. Returns the number of documents migrated.
+    """
+    storage = Dokumenti._meta.get_field("file").storage
+    migrated = 0
+    docs = (
+        Dokumenti.objects.exclude(file="").exclude(file__isnull=True)
+        .values_list("id", "file")
+    )
+    for doc_id, name in docs.iterator():
+        if is_blob(name) or not storage.exists(name):
+            continue
+        migrated += 1
+        if dry_run:
+            continue
+        new_name = storage.save_local(storage.path(name), link=True)
+        Dokumenti.objects.filter(id=doc_id).update(file=new_name)
+        if not Dokumenti.objects.filter(file=name).exists():
+            storage.delete(name)
+    return migrated
+
+
+def compress_attachments(compression, dry_run=False):
+    """
+    Re-store uncompressed XML attachments compressed with `compression`.
+    Returns (files, bytes_before, bytes_after); with dry_run only the
+    candidates are counted (bytes_after stays 0).
+    """
+    storage = Dokumenti._meta.get_field("file").storage
+    names = list(
+        Dokumenti.objects.filter(file__iendswith=".xml")
+        .values_list("file", flat=True).distinct()
+    )
+    files = before = after = 0
+    for name in names:
+        if compression_of(name) or not storage.exists(name):
+            continue
+        files += 1
+        before += storage.size(name)
+        if dry_run:
+            continue
+        new_name = storage.compress(name, compression)
+        after += storage.size(new_name)
+        # one UPDATE moves every document sharing the blob
+        Dokumenti.objects.filter(file=name).update(file=new_name)
+        storage.delete(name)
+    return files, before, after
@@ -0,0 +1,238 @@
+# gtbook/utils/sef_import.py
+import logging
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, connections, transaction
+
+from gtbook.models import Dokumenti, Klijenti
+from gtbook.utils.faktura_xml_extract import extract_invoice_file
+from gtbook.utils.log import log_stage
+from gtbook.utils.webhook_processing import (
+    ITEM_MODELS, build_invoice, build_items, new_client_from_xml, normalize_pib,
+    partner_from_xml,
+)
+
+logger = logging.getLogger(__name__)
+
+
+def sef_key(extracted):
+    """(invoice_type, sef_id) from the envelope header, or (None, None)."""
+    header = extracted["header"]
+    if header.get("PurchaseInvoiceId"):
+        return "ulazne", header["PurchaseInvoiceId"]
+    if header.get("SalesInvoiceId"):
+        return "izlazne", header["SalesInvoiceId"]
+    return None, None
+
+
+def parse_files(paths, workers=1, chunksize=16):
+    """
+    Yield extract_invoice_file() results in input order, parsed by a process
+    pool when workers > 1 (parsing is CPU-bound, so threads wouldn't help).
+    """
+    if workers <= 1:
+        yield from map(extract_invoice_file, paths)
+        return
+    # forked children must not share the parent's DB connection
+    connections.close_all()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        yield from pool.map(extract_invoice_file, paths, chunksize=chunksize)
+
+
+def _describe(error):
+    if isinstance(error, ValidationError) and hasattr(error, "error_dict"):
+        return "; ".join(f"{field}: {' '.join(messages)}" for field, messages in error.message_dict.items())
+    return f"{type(error).__name__}: {error}"
+
+
+def _validate(obj):
+    """
+    Field checks the insert would fail on (bad dates or amounts, values too
+    long or not among the choices) — without queries: relations, generated
+    fields and empty fields, which fall back to their defaults, are left out.
+    """
+    obj.clean_fields(exclude=[
+        field.name for field in obj._meta.concrete_fields
+        if field.is_relation or field.generated or field.value_from_object(obj) in field.empty_values
+    ])
+
+
+class SefImporter:
+    """
+    Insert already extracted SEF invoices in batches: clients are resolved
+    through one in-memory PIB → id map, and every batch is written with a
+    few bulk_create calls in a single transaction.
+
+    Each file is built and validated on its own first, so a broken one fails
+    alone. Should the batch insert still fail (e.g. a document added by
+    someone else meanwhile), the batch is retried row by row in savepoints.
+    Every file is counted exactly once: imported, skipped or failed.
+
+    Invoices whose SEF id or (dok_tip, dok_br) already exists are skipped,
+    so an interrupted import can simply be run again.
+    """
+
+    def __init__(self, attach_files=True):
+        self.attach_files = attach_files
+        self.clients = dict(Klijenti.objects.values_list("pib", "id"))
+        self.stats = Counter()
+        self.errors = []
+
+    def fail(self, path, error):
+        self.stats["failed"] += 1
+        self.errors.append((path, error))
+
+    def _existing(self, rows):
+        """SEF ids and document numbers of `rows` that are already in the DB."""
+        sef_ids = {"ulazne": set(), "izlazne": set()}
+        numbers = {"ULF": set(), "IZF": set()}
+        for row in rows:
+            sef_ids[row["type"]].add(row["sef_id"])
+            numbers[row["dok_tip"]].add(row["dok_br"])
+
+        seen_sef = set()
+        for invoice_type, ids in sef_ids.items():
+            field = "purchaseInvoiceId" if invoice_type == "ulazne" else "salesInvoiceId"
+            if ids:
+                seen_sef.update(
+                    (invoice_type, sef_id) for sef_id in Dokumenti.objects.filter(
+                        **{f"{field}__in": ids}
+                    ).values_list(field, flat=True)
+                )
+        seen_numbers = set()
+        for dok_tip, dok_brs in numbers.items():
+            if dok_brs:
+                seen_numbers.update(
+                    (dok_tip, dok_br) for dok_br in Dokumenti.objects.filter(
+                        dok_tip=dok_tip, dok_br__in=dok_brs
+                    ).values_list("dok_br", flat=True)
+                )
+        return seen_sef, seen_numbers
+
+    def _prepare(self, row, new_clients):
+        """
+        Validated, unsaved document and items of one row. A client not in the
+        DB yet is taken from (or added to) `new_clients` — only once
+        everything else succeeded, so a failing row leaves no client behind.
+        """
+        partner = row["partner"]
+        pib = normalize_pib(partner["pib"])
+        doc = build_invoice(row["type"], row["extracted"], self.clients.get(pib))
+        doc_items = build_items(doc, row["type"], row["extracted"])
+        _validate(doc)
+        for item in doc_items:
+            _validate(item)
+        if self.attach_files:
+            if "file" not in row:
+                row["file"] = self._store(row["path"])
+            doc.file.name = row["file"]
+        if doc.klijent_id is None:
+            if pib not in new_clients:
+                new_clients[pib] = new_client_from_xml(partner)
+            # bulk_create fills in klijent_id once the client has its pk
+            doc.klijent = new_clients[pib]
+        return doc, doc_items
+
+    def _insert(self, new_clients, docs, items):
+        Klijenti.objects.bulk_create(new_clients.values())
+        Dokumenti.objects.bulk_create(docs)
+        # bulk_create picks up the document pks set just above
+        for invoice_type, invoice_items in items.items():
+            ITEM_MODELS[invoice_type][0].objects.bulk_create(invoice_items)
+
+    def _imported(self, new_clients, docs, items):
+        # only now are the new clients really there
+        for pib, client in new_clients.items():
+            self.clients[pib] = client.id
+        self.stats["imported"] += len(docs)
+        self.stats["items"] += sum(len(invoice_items) for invoice_items in items.values())
+        self.stats["clients"] += len(new_clients)
+
+    def import_batch(self, parsed):
+        """Import a list of (path, extracted) pairs."""
+        rows = []
+        for path, extracted in parsed:
+            invoice_type, sef_id = sef_key(extracted)
+            dok_br = extracted["invoice"].get("ID")
+            if invoice_type is None or not dok_br:
+                self.fail(path, "Nema SEF id ili broja fakture")
+                continue
+            rows.append({
+                "path": path,
+                "type": invoice_type,
+                "sef_id": sef_id,
+                "dok_tip": "ULF" if invoice_type == "ulazne" else "IZF",
+                "dok_br": dok_br,
+                "extracted": extracted,
+            })
+        if not rows:
+            return
+
+        with log_stage(logger, "import.batch", files=len(parsed)) as stage:
+            try:
+                seen_sef, seen_numbers = self._existing(rows)
+            except DatabaseError as e:
+                for row in rows:
+                    self.fail(row["path"], _describe(e))
+                return
+
+            accepted = []
+            new_clients = {}
+            docs = []
+            items = {invoice_type: [] for invoice_type in ITEM_MODELS}
+            for row in rows:
+                sef = (row["type"], row["sef_id"])
+                number = (row["dok_tip"], row["dok_br"])
+                if sef in seen_sef or number in seen_numbers:
+                    self.stats["skipped"] += 1
+                    continue
+                row["partner"] = partner_from_xml(row["type"], row["extracted"])
+                if not row["partner"]["pib"]:
+                    self.fail(row["path"], "Nema PIB partnera")
+                    continue
+                try:
+                    doc, doc_items = self._prepare(row, new_clients)
+                except Exception as e:
+                    self.fail(row["path"], _describe(e))
+                    continue
+                seen_sef.add(sef)
+                seen_numbers.add(number)
+                accepted.append(row)
+                docs.append(doc)
+                items[row["type"]] += doc_items
+            if not accepted:
+                return
+
+            try:
+                with transaction.atomic():
+                    self._insert(new_clients, docs, items)
+            except DatabaseError as e:
+                logger.warning("Import batch failed (%s), retrying file by file", _describe(e))
+                self._import_rows(accepted)
+                return
+
+            self._imported(new_clients, docs, items)
+            stage.fields.update(
+                docs=len(docs), items=sum(len(i) for i in items.values()), clients=len(new_clients),
+            )
+
+    def _import_rows(self, rows):
+        """Fallback for a failed batch: one savepoint per row, built afresh."""
+        with transaction.atomic():
+            for row in rows:
+                new_clients = {}
+                items = {invoice_type: [] for invoice_type in ITEM_MODELS}
+                doc, items[row["type"]] = self._prepare(row, new_clients)
+                try:
+                    with transaction.atomic():
+                        self._insert(new_clients, [doc], items)
+                except DatabaseError as e:
+                    self.fail(row["path"], _describe(e))
+                    continue
+                self._imported(new_clients, [doc], items)
+
+    def _store(self, path):
+        # copied, never linked: the archive belongs to the user and may change
+        return Dokumenti._meta.get_field("file").storage.save_local(path)
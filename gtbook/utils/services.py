@@ -1,41 +1,99 @@
-def attach_otpremnice_to_faktura(faktura, otpremnice_ids):
-    from gtbook.models import Dokumenti, OtpremnicaStavka, FakturaStavka
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from gtbook.models import Dokumenti, FakturaStavka, OtpremnicaStavka, UlaznaFakturaStavka
 
-    otpremnice = Dokumenti.objects.filter(id__in=otpremnice_ids, dok_tip='OTP')
+# dok_tip: (item model, FK field to Dokumenti)
+STAVKE_MODELS = {
+    "IZF": (FakturaStavka, "faktura"),
+    "OTP": (OtpremnicaStavka, "otpremnica"),
+    "ULF": (UlaznaFakturaStavka, "ulazna_faktura"),
+}
 
-    for otp in otpremnice:
-        # link
-        otp.faktura = faktura
-        otp.save()
+IZNOS = DecimalField(max_digits=12, decimal_places=2)
 
-        # copy items
-        items = otp.stavke_otp.all()
-        for item in items:
-            FakturaStavka.objects.create(
-                faktura=faktura,
-                naziv=item.naziv,
-                tip_prometa=item.tip_prometa,
-                kolicina=item.kolicina,
-                cena=item.cena,
-                jed_mere=item.jed_mere,
-            )
+# fields copied when items move between document types
+ITEM_FIELDS = ("naziv", "tip_prometa", "kolicina", "cena", "jed_mere")
 
-    # update totals
-    recalc_faktura_totals(faktura)
+def negate_kolicina(row):
+    """clone_items transform for storno documents."""
+    row["kolicina"] = -row["kolicina"]
 
-def recalc_faktura_totals(faktura):
-    total_P = 0
-    total_U = 0
+def clone_items(items, target, transform=None):
+    """
+    Copy `items` (a queryset of any of the three item models) to document
+    `target`, as items of the model matching target.dok_tip — one SELECT and
+    one bulk INSERT however many rows there are. `transform(row)` may change
+    each row (a dict of ITEM_FIELDS) in place before it is inserted.
+    Invoice items copied from an otpremnica remember their source item
+    (FakturaStavka.source_otp), so unlinking can remove exactly those.
+    Returns the created items.
+    """
+    Model, fk_field = STAVKE_MODELS[target.dok_tip]
+    track_source = items.model is OtpremnicaStavka and Model is FakturaStavka
+    new_items = []
+    for row in items.order_by("id").values("id", *ITEM_FIELDS):
+        source_id = row.pop("id")
+        if transform:
+            transform(row)
+        if track_source:
+            row["source_otp_id"] = source_id
+        new_items.append(Model(**{fk_field: target}, **row))
+    return Model.objects.bulk_create(new_items)
+
+def attach_otpremnice_to_faktura(faktura, otpremnice_ids):
+    with transaction.atomic():
+        otpremnice = Dokumenti.objects.filter(id__in=otpremnice_ids, dok_tip='OTP')
+        clone_items(OtpremnicaStavka.objects.filter(otpremnica__in=otpremnice), faktura)
+        otpremnice.update(faktura=faktura)
+        recalc_totals(faktura)
 
-    for item in faktura.stavke_izf.all():
-        if item.tip_prometa == "P":
-            total_P += item.iznos
-        else:
-            total_U += item.iznos
+def document_totals(dok):
+    """
+    (iznos_P, iznos_U) of a document from its items' stored iznos_stavke —
+    one aggregate query, no items loaded.
+    """
+    Model, fk_field = STAVKE_MODELS[dok.dok_tip]
+    totals = Model.objects.filter(**{fk_field: dok}).aggregate(
+        P=Sum("iznos_stavke", filter=Q(tip_prometa="P"), default=Decimal(0)),
+        U=Sum("iznos_stavke", filter=Q(tip_prometa="U"), default=Decimal(0)),
+    )
+    return totals["P"], totals["U"]
 
-    faktura.iznos_P = total_P
-    faktura.iznos_U = total_U
-    faktura.save()
+def recalc_totals(dok):
+    """Recompute and save iznos_P / iznos_U of one document."""
+    dok.iznos_P, dok.iznos_U = document_totals(dok)
+    dok.save(update_fields=["iznos_P", "iznos_U"])
 
+def _items_total(dok_tip, tip_prometa):
+    # correlated subquery: SUM(iznos_stavke) of the outer document's items
+    Model, fk_field = STAVKE_MODELS[dok_tip]
+    items = (
+        Model.objects.filter(**{fk_field: OuterRef("pk"), "tip_prometa": tip_prometa})
+        .order_by().values(fk_field)
+        .annotate(total=Sum("iznos_stavke")).values("total")
+    )
+    return Coalesce(Subquery(items, output_field=IZNOS), Value(Decimal(0)), output_field=IZNOS)
 
+def recalc_totals_bulk(documents):
+    """
+    Recompute iznos_P / iznos_U of every document in `documents` (a Dokumenti
+    queryset) with one UPDATE per document type; rows whose totals already
+    match are left alone. Returns the number of rows changed.
 
+    There is deliberately no "all documents" default: totals of invoices
+    taken over from SEF come from the XML (PayableAmount), not from their
+    items, and must not be overwritten by a bare call.
+    """
+    changed = 0
+    for dok_tip in STAVKE_MODELS:
+        iznos_P, iznos_U = _items_total(dok_tip, "P"), _items_total(dok_tip, "U")
+        changed += (
+            documents.filter(dok_tip=dok_tip)
+            .exclude(iznos_P=iznos_P, iznos_U=iznos_U)
+            .update(iznos_P=iznos_P, iznos_U=iznos_U)
+        )
+    return changed
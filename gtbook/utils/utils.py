@@ -1,75 +1,95 @@
 # gtbook/utils.py
+from django.db import IntegrityError, transaction
 from django.db.models import Max, Q, F, IntegerField, ExpressionWrapper
+from django.db.transaction import TransactionManagementError
 from datetime import date
-from ..models import Dokumenti, Klijenti
+from ..models import Dokumenti, DokumentBrojac, Klijenti, DEF_AKTIVAN, DEF_DOBAVLJAC, DEF_KUPAC
 
-def next_dok_number(tip):
-    year_suffix = str(date.today().year)[-2:]  # e.g. '25'
-
-    # IZF numbering: YY0001, YY0002, ...
-    if tip == "IZF":
-        last = (
-            Dokumenti.objects
-            .filter(dok_tip="IZF", dok_br__startswith=year_suffix)
-            .aggregate(Max("dok_br"))["dok_br__max"]
-        )
-
-        if last:
-            # take the last 4 digits safely
-            seq = int(last[-4:])
-            next_num = seq + 1
-        else:
-            next_num = 1
-
-        return f"{year_suffix}{next_num:04d}"
+# auto-numbered types: IZF YY0001, YY0002, ...; OTP OT-YY0001, ...
+DOK_BR_PREFIX = {
+    "IZF": "",
+    "OTP": "OT-",
+}
 
-    # OTP numbering: OT-YY0001, OT-YY0002, ...
-    if tip == "OTP":
-        prefix = f"OT-{year_suffix}"
+def _format_dok_br(tip, year, seq):
+    return f"{DOK_BR_PREFIX[tip]}{year % 100:02d}{seq:04d}"
 
-        last = (
-            Dokumenti.objects
-            .filter(dok_tip="OTP", dok_br__startswith=prefix)
-            .aggregate(Max("dok_br"))["dok_br__max"]
-        )
+def _last_used_seq(tip, year):
+    """Highest sequence already used for tip/year, read from the documents themselves."""
+    prefix = _format_dok_br(tip, year, 0)[:-4]
+    last = (
+        Dokumenti.objects
+        .filter(dok_tip=tip, dok_br__startswith=prefix)
+        .aggregate(Max("dok_br"))["dok_br__max"]
+    )
+    # take the last 4 digits safely, e.g. OT-250025 → 25
+    return int(last[-4:]) if last and last[-4:].isdigit() else 0
 
-        if last:
-            # Example last: OT-250025
-            # Extract last 4 digits:
-            seq = int(last[-4:])   # "0025" → 25
-            next_num = seq + 1
-        else:
-            next_num = 1
+def _create_counter(tip, year):
+    # First number of the year (or first use of the counter table): continue
+    # after whatever the documents already use. The savepoint lets a
+    # concurrent request win the race without breaking our transaction.
+    try:
+        with transaction.atomic():
+            DokumentBrojac.objects.create(
+                dok_tip=tip, godina=year, poslednji=_last_used_seq(tip, year)
+            )
+    except IntegrityError:
+        pass
 
-        return f"OT-{year_suffix}{next_num:04d}"
-
-    # fallback if someone adds a new type but forgets numbering:
-    return f"{year_suffix}0001"
+def next_dok_number(tip):
+    """
+    Preview of the next number for a form. Nothing is reserved — the number
+    is only handed out by reserve_dok_number when the document is saved.
+    """
+    year = date.today().year
+    if tip not in DOK_BR_PREFIX:
+        # fallback if someone adds a new type but forgets numbering:
+        return f"{year % 100:02d}0001"
 
-def filter_klijenti_by_tip_sqlite(tip):
-    all_clients = Klijenti.objects.all()
-    filtered_ids = []
+    last = (
+        DokumentBrojac.objects.filter(dok_tip=tip, godina=year)
+        .values_list("poslednji", flat=True).first()
+    )
+    if last is None:
+        last = _last_used_seq(tip, year)
+    return _format_dok_br(tip, year, last + 1)
 
-    for c in all_clients:
-        kupac = c.defcode & 1
-        dobavljac = c.defcode & 2
-        sef = c.defcode & 4
-        #crf = c.defcode & 8
-        aktivan = c.defcode & 16
+def reserve_dok_number(tip):
+    """
+    Hand out the next number of `tip` for the current year. Must run inside
+    the transaction that saves the document: the counter row stays
+    write-locked until it commits, so concurrent creates get distinct
+    numbers, and a rollback gives the number back.
+    """
+    if not transaction.get_connection().in_atomic_block:
+        raise TransactionManagementError("reserve_dok_number must run inside transaction.atomic()")
+    year = date.today().year
+    if tip not in DOK_BR_PREFIX:
+        return next_dok_number(tip)
 
-        if not aktivan:
+    counter = DokumentBrojac.objects.filter(dok_tip=tip, godina=year)
+    while True:
+        # UPDATE first: the write lock is taken before anything is read
+        if not counter.update(poslednji=F("poslednji") + 1):
+            _create_counter(tip, year)
             continue
+        number = _format_dok_br(tip, year, counter.values_list("poslednji", flat=True).get())
+        # skip a number someone already typed in by hand
+        if not Dokumenti.objects.filter(dok_tip=tip, dok_br=number).exists():
+            return number
+
+# client role needed per document type; other types only need "aktivan"
+KLIJENT_ULOGA = {
+    "IZF": DEF_KUPAC,
+    "OTP": DEF_KUPAC,
+    "ULF": DEF_DOBAVLJAC,
+}
 
-        if tip == "IZF" and kupac:# and sef:
-            filtered_ids.append(c.id)
-        elif tip == "ULF" and dobavljac:
-            filtered_ids.append(c.id)
-        elif tip == "OTP" and kupac:
-            filtered_ids.append(c.id)
-        elif tip not in ("IZF", "ULF", "OTP"):
-            filtered_ids.append(c.id)
-        
-    return Klijenti.objects.filter(id__in=filtered_ids)
+def filter_klijenti_by_tip(tip):
+    """Active clients usable on a `tip` document — one query, bits tested in SQL."""
+    mask = DEF_AKTIVAN | KLIJENT_ULOGA.get(tip, 0)
+    return Klijenti.objects.filter(defcode__bitand=mask)
 
 def format_qty(x):
     return int(x) if float(x).is_integer() else x
@@ -0,0 +1,146 @@
+# gtbook/utils/webhook_ingest.py
+import threading
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+from gtbook.models import WebhookEvent
+
+
+class WebhookIngestError(Exception):
+    """The batch containing this request could not be written."""
+
+
+def normalize_payload(data):
+    """
+    Split a SEF callback body into single invoice events.
+    SEF may post one event object or a list of them; every event becomes
+    its own WebhookEvent row. Raises ValueError for anything else.
+    """
+    events = data if isinstance(data, list) else [data]
+    if not all(isinstance(event, dict) for event in events):
+        raise ValueError("Event mora biti JSON objekat")
+    return events
+
+
+class _Batch:
+    def __init__(self):
+        self.rows = []
+        self.full = threading.Event()
+        self.done = threading.Event()
+        self.flushing = False
+        self.error = None
+
+
+class WebhookIngestBuffer:
+    """
+    Group commit for incoming webhooks. Concurrent requests add their rows to
+    the open batch; one of them (the leader) writes the whole batch with a
+    single bulk_create while the others wait. Every caller returns only after
+    its rows are committed, so SEF is acknowledged for durable data only.
+
+    The leader waits at most `max_wait` seconds (or until `max_batch` rows are
+    buffered) and then for any flush already in progress — requests arriving
+    meanwhile join the batch. A follower waits at most `wait_timeout` seconds
+    for the leader: if the flush hasn't started by then it takes its rows back
+    and inserts them itself; if it has, it waits once more and then gives up
+    with WebhookIngestError (SEF retries the callback).
+    """
+
+    def __init__(self, max_batch=200, max_wait=0.005, wait_timeout=10.0):
+        self.max_batch = max_batch
+        self.max_wait = max_wait
+        self.wait_timeout = wait_timeout
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._open = None
+
+    def submit(self, rows):
+        with self._lock:
+            batch = self._open
+            leader = batch is None
+            if leader:
+                batch = self._open = _Batch()
+            batch.rows.extend(rows)
+            if len(batch.rows) >= self.max_batch:
+                # close it: later requests start a new batch
+                self._open = None
+                batch.full.set()
+
+        if leader:
+            if self.max_wait:
+                batch.full.wait(self.max_wait)
+            with self._flush_lock:
+                with self._lock:
+                    if self._open is batch:
+                        self._open = None
+                    batch.flushing = True
+                self._flush(batch)
+        elif not batch.done.wait(self.wait_timeout):
+            batch = self._leave(batch, rows)
+
+        if batch.error is not None:
+            raise WebhookIngestError("Webhook nije sačuvan") from batch.error
+        return len(rows)
+
+    def _leave(self, batch, rows):
+        """A follower gave up on a stalled leader; returns the batch that holds its rows."""
+        with self._lock:
+            if not batch.flushing:
+                own = {id(row) for row in rows}
+                batch.rows = [row for row in batch.rows if id(row) not in own]
+                if self._open is batch and not batch.rows:
+                    self._open = None
+                batch = None
+        if batch is None:
+            # not written by anyone yet: write them without the leader
+            batch = _Batch()
+            batch.rows = rows
+            self._flush(batch)
+        elif not batch.done.wait(self.wait_timeout):
+            # the leader's insert is under way (or hung) — the rows must not be
+            # inserted twice, so fail and let SEF retry the callback
+            raise WebhookIngestError("Webhook nije sačuvan: upis kasni")
+        return batch
+
+    def _flush(self, batch):
+        try:
+            with transaction.atomic():
+                WebhookEvent.objects.bulk_create(batch.rows, batch_size=self.max_batch)
+        except Exception as e:
+            batch.error = e
+        finally:
+            batch.done.set()
+
+
+_buffer = WebhookIngestBuffer(
+    max_batch=settings.WEBHOOK_INGEST_MAX_BATCH,
+    max_wait=settings.WEBHOOK_INGEST_WINDOW_MS / 1000,
+    wait_timeout=settings.WEBHOOK_INGEST_WAIT_TIMEOUT,
+)
+
+
+def ingest_webhook_events(webhook_type, events):
+    """Durably store already normalized events; returns the number of rows."""
+    rows = [WebhookEvent(payload=event, type=webhook_type) for event in events]
+    if not rows:
+        return 0
+    return _buffer.submit(rows)
+
+
+def _ingest_and_release(webhook_type, events):
+    try:
+        return ingest_webhook_events(webhook_type, events)
+    finally:
+        # runs on a pool thread outside Django's request cycle
+        close_old_connections()
+
+
+async def aingest_webhook_events(webhook_type, events):
+    """
+    Async variant for ASGI views. The wait for the group commit happens on a
+    worker thread (not the single thread_sensitive one), so the event loop
+    keeps accepting callbacks and concurrent requests share one insert.
+    """
+    return await sync_to_async(_ingest_and_release, thread_sensitive=False)(webhook_type, events)
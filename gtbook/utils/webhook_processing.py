@@ -1,15 +1,28 @@
 from gtbook.models import Klijenti, Dokumenti, FakturaStavka, UlaznaFakturaStavka, WebhookLog
 from django.db import transaction
+from django.db.models import Q
 from gtbook.utils.faktura_xml_extract import extract_full_invoice
 import requests
 from pathlib import Path
 from django.conf import settings
 from decimal import Decimal
-from django.db.models import Max
-from django.core.files import File
+import itertools
 import traceback
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from gtbook.utils.log import log_event, log_stage
 from gtbook.utils.sef_http import sef_get
 
+logger = logging.getLogger(__name__)
+
+
+class WebhookPermanentError(Exception):
+    """The event can never succeed (malformed payload, SEF 4xx) — don't retry it."""
+
+
+class SefTransientError(Exception):
+    """SEF is temporarily unavailable (5xx, timeout, empty answer) — retry later."""
+
 
 SEF_STATUS_MAP = {
     "Draft": "NAC",
@@ -26,60 +39,137 @@ SEF_STATUS_MAP = {
     "Unknown": "NEP"
 }
 
-def process_webhook(webhook):
-    try:
-        events = webhook.payload if isinstance(webhook.payload, list) else [webhook.payload]
-
-        for event in events:
-            sef_id, invoice_type = get_sef_invoice_id(event, webhook.type)
+# WebhookLog inserts since start; the log is trimmed once every
+# WEBHOOK_LOG_TRIM_EVERY of them instead of after each event.
+_log_inserts = itertools.count(1)
 
-            status_raw = event.get("NewInvoiceStatus")
-            status = SEF_STATUS_MAP.get(status_raw, status_raw)
-            comment = event.get("Comment")
+def coalesce_events(webhooks):
+    """
+    Group the SEF events of several WebhookEvent rows by (type, invoice id),
+    in arrival order. SEF often sends Sent → Seen → Approved for the same
+    invoice in quick succession; only the latest status has to be applied.
 
-            with transaction.atomic():
-                doc = None
-                xml_path = None
-                extracted = None
+    Returns (groups, invalid): `groups` is a list of dicts
+    {invoice_type, sef_id, statuses, comment, webhook_ids} and `invalid` maps
+    the id of every row with a malformed payload to its exception.
+    """
+    groups = {}
+    invalid = {}
 
-                lookup = (
-                    {"purchaseInvoiceId": sef_id}
-                    if invoice_type == "ulazne"
-                    else {"salesInvoiceId": sef_id}
-                )
-                doc = Dokumenti.objects.filter(**lookup).first()
+    for webhook in webhooks:
+        events = webhook.payload if isinstance(webhook.payload, list) else [webhook.payload]
+        try:
+            keys = [get_sef_invoice_id(event, webhook.type) for event in events]
+        except WebhookPermanentError as e:
+            invalid[webhook.id] = e
+            continue
+
+        for event, (sef_id, invoice_type) in zip(events, keys):
+            group = groups.setdefault((invoice_type, sef_id), {
+                "invoice_type": invoice_type,
+                "sef_id": sef_id,
+                "statuses": [],
+                "comment": None,
+                "webhook_ids": [],
+            })
+            group["statuses"].append(event.get("NewInvoiceStatus"))
+            group["comment"] = event.get("Comment")
+            if webhook.id not in group["webhook_ids"]:
+                group["webhook_ids"].append(webhook.id)
+
+    return list(groups.values()), invalid
+
+def drop_superseded(groups):
+    """
+    Split coalesced `groups` into (live, superseded). Coalescing only sees
+    one claimed batch; a group is superseded when its invoice already
+    carries the status of the same or a newer event (Dokumenti.sef_event_id)
+    — a retry, or an event whose lease outlived a newer one. Superseded
+    groups need no SEF download and no update. One query per invoice type.
+    """
+    wanted = {"ulazne": set(), "izlazne": set()}
+    for group in groups:
+        wanted[group["invoice_type"]].add(group["sef_id"])
+
+    applied = {}
+    for invoice_type, sef_ids in wanted.items():
+        if not sef_ids:
+            continue
+        field = "purchaseInvoiceId" if invoice_type == "ulazne" else "salesInvoiceId"
+        applied.update(
+            ((invoice_type, sef_id), event_id) for sef_id, event_id in
+            Dokumenti.objects.filter(**{f"{field}__in": sef_ids}, sef_event_id__isnull=False)
+            .values_list(field, "sef_event_id")
+        )
 
-                if not doc or not doc.file:
-                    xml_path = Path(settings.MEDIA_ROOT) / "sef_tmp" / f"{invoice_type}_{sef_id}.xml"
-                    if not xml_path.exists():
-                        xml_path = download_invoice_xml(sef_id, invoice_type)
-                    extracted = extract_full_invoice(xml_path)
-                    if not extracted:
-                        raise Exception("No extracted data available")
+    live, superseded = [], []
+    for group in groups:
+        event_id = applied.get((group["invoice_type"], group["sef_id"]))
+        if event_id is not None and event_id >= group["webhook_ids"][-1]:
+            superseded.append(group)
+        else:
+            live.append(group)
+    return live, superseded
 
-                if not doc:
-                    doc, created = get_or_create_invoice(sef_id, invoice_type, extracted)
-                else:
-                    created = False
+def process_invoice_event(group):
+    """Apply the latest status of a coalesced event group to its invoice."""
+    sef_id = group["sef_id"]
+    invoice_type = group["invoice_type"]
 
+    status_raw = group["statuses"][-1]
+    status = SEF_STATUS_MAP.get(status_raw, status_raw)
+    comment = group["comment"]
 
-                if xml_path:
-                    attach_xml_if_missing(doc, xml_path)
+    doc = None
+    xml_path = None
+    extracted = None
 
-                if extracted:
-                    insert_items(doc, invoice_type, extracted)
+    lookup = (
+        {"purchaseInvoiceId": sef_id}
+        if invoice_type == "ulazne"
+        else {"salesInvoiceId": sef_id}
+    )
+    doc = Dokumenti.objects.filter(**lookup).first()
 
-                doc.status_SEF = status
-                doc.comment_SEF = comment
-                doc.save(update_fields=["status_SEF", "comment_SEF"])
+    # Everything that talks to SEF or parses files happens before the
+    # transaction, so the (SQLite) write lock is held for milliseconds only.
+    if not doc or not doc.file:
+        xml_path = sef_tmp_path(invoice_type, sef_id)
+        if not xml_path.exists():
+            # normally already fetched by prefetch_invoice_xml()
+            xml_path = download_invoice_xml(sef_id, invoice_type)
+        extracted = extract_full_invoice(xml_path)
+        if not extracted:
+            raise Exception("No extracted data available")
+
+    with log_stage(logger, "invoice.apply", type=invoice_type, sef_id=sef_id,
+                   events=len(group["statuses"])), transaction.atomic():
+        if not doc:
+            doc, created = get_or_create_invoice(sef_id, invoice_type, extracted)
+        else:
+            created = False
+
+
+        if xml_path:
+            attach_xml_if_missing(doc, xml_path)
+
+        if extracted:
+            insert_items(doc, invoice_type, extracted)
+
+        # Events are ordered by id. A retried (or long-leased) older event
+        # must not overwrite a status a newer one has already set.
+        event_id = group["webhook_ids"][-1]
+        applied = Dokumenti.objects.filter(
+            Q(sef_event_id__isnull=True) | Q(sef_event_id__lt=event_id), pk=doc.pk,
+        ).update(status_SEF=status, comment_SEF=comment, sef_event_id=event_id)
+        if not applied:
+            log_event(logger, "invoice.superseded", type=invoice_type, sef_id=sef_id, webhook_id=event_id)
+            return
 
-                webhook_log(webhook, doc)
+        doc.status_SEF, doc.comment_SEF, doc.sef_event_id = status, comment, event_id
+        webhook_log(event_id, invoice_type, doc, group["statuses"])
 
-        return True, None
-    except Exception as e:
-        return False, str(e)
-    
-def webhook_log(webhook, doc):
+def webhook_log(webhook_id, webhook_type, doc, statuses=None):
     doc_number = getattr(doc, "dok_br", None)
     status = getattr(doc, "status_SEF", None)
     comment = getattr(doc, "comment_SEF", None)
@@ -89,26 +179,87 @@ def webhook_log(webhook, doc):
         client = doc.klijent
         client_name = getattr(client, "ime", None)
 
+    message = f"Faktura: {doc_number} ({webhook_type}); Novi status: {status}; Komentar: {comment}"
+    if statuses and len(statuses) > 1:
+        # one entry for the whole collapsed chain
+        message += "; Statusi: " + " → ".join(str(s) for s in statuses)
+
     WebhookLog.objects.create(
-        webhook_id=webhook.id,
+        webhook_id=webhook_id,
         doc_number=doc_number,
         client_name=client_name,
-        message=f"Faktura: {doc_number} ({webhook.type}); Novi status: {status}; Komentar: {comment}"
+        message=message,
     )
 
-    WebhookLog.trim()
+    if next(_log_inserts) % max(settings.WEBHOOK_LOG_TRIM_EVERY, 1) == 0:
+        # after commit, so retention never runs inside the processing transaction
+        transaction.on_commit(WebhookLog.trim)
 
 def get_sef_invoice_id(event, webhook_type):
-    if webhook_type == "ulazne":
-        return str(event["PurchaseInvoiceId"]), "ulazne"
-    else:
-        return str(event["SalesInvoiceId"]), "izlazne"
+    invoice_type = "ulazne" if webhook_type == "ulazne" else "izlazne"
+    key = "PurchaseInvoiceId" if invoice_type == "ulazne" else "SalesInvoiceId"
+    if not isinstance(event, dict) or event.get(key) is None:
+        raise WebhookPermanentError(f"Payload nema {key}")
+    return str(event[key]), invoice_type
+
+def sef_tmp_path(invoice_type, sef_id):
+    return Path(settings.MEDIA_ROOT) / "sef_tmp" / f"{invoice_type}_{sef_id}.xml"
+
+def invoices_missing_xml(groups):
+    """
+    Return the (invoice_type, sef_id) keys of `groups` that still need the
+    SEF XML: no document yet, or a document without an attached file, and
+    no copy in sef_tmp. One query per invoice type.
+    """
+    wanted = {"ulazne": set(), "izlazne": set()}
+    for group in groups:
+        wanted[group["invoice_type"]].add(group["sef_id"])
+
+    missing = []
+    for invoice_type, sef_ids in wanted.items():
+        if not sef_ids:
+            continue
+        field = "purchaseInvoiceId" if invoice_type == "ulazne" else "salesInvoiceId"
+        attached = set(
+            Dokumenti.objects.filter(**{f"{field}__in": sef_ids})
+            .exclude(file="").exclude(file__isnull=True)
+            .values_list(field, flat=True)
+        )
+        missing += [
+            (invoice_type, sef_id) for sef_id in sorted(sef_ids - attached)
+            if not sef_tmp_path(invoice_type, sef_id).exists()
+        ]
+    return missing
+
+def prefetch_invoice_xml(groups, max_workers=4):
+    """
+    Download the missing SEF XMLs for `groups` concurrently with a bounded
+    thread pool, before any DB transaction is opened.
+    Returns {(invoice_type, sef_id): exception} for failed downloads.
+    """
+    missing = invoices_missing_xml(groups)
+    if not missing:
+        return {}
+
+    with log_stage(logger, "sef.prefetch", downloads=len(missing)) as stage:
+        with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as pool:
+            futures = {
+                key: pool.submit(download_invoice_xml, key[1], key[0])
+                for key in missing
+            }
+        errors = {
+            key: future.exception()
+            for key, future in futures.items()
+            if future.exception() is not None
+        }
+        stage.fields["failed"] = len(errors)
+    return errors
 
 def download_invoice_xml(sef_id, invoice_type):
     base_path = Path(settings.MEDIA_ROOT) / "sef_tmp"
     base_path.mkdir(parents=True, exist_ok=True)
 
-    xml_path = base_path / f"{invoice_type}_{sef_id}.xml"
+    xml_path = sef_tmp_path(invoice_type, sef_id)
     debug_path = base_path / f"{invoice_type}_{sef_id}_debug.txt"
 
     endpoint = (
@@ -120,23 +271,24 @@ def download_invoice_xml(sef_id, invoice_type):
     url = f"https://{settings.SEF}.mfin.gov.rs/api/publicApi/{endpoint}"
 
     try:
-        r = sef_get(
-            url,
-            params={"invoiceId": sef_id},
-            headers={
-                "ApiKey": settings.SEF_API_KEY,
-                "Accept": "application/xml",
-                "User-Agent": "Mozilla/5.0",
-                "Accept-Encoding": "identity",
-            },
-            timeout=30,
-        )
+        try:
+            with log_stage(logger, "sef.download", type=invoice_type, sef_id=sef_id):
+                r = sef_get(
+                    url,
+                    params={"invoiceId": sef_id},
+                    headers={
+                        "ApiKey": settings.SEF_API_KEY,
+                        "Accept": "application/xml",
+                        "User-Agent": "Mozilla/5.0",
+                        "Accept-Encoding": "identity",
+                    },
+                    timeout=30,
+                )
+        except requests.RequestException as e:
+            raise SefTransientError(f"SEF nije dostupan: {e}") from e
 
         content = r.content or b""
 
-        # Write XML (even if empty, for visibility)
-        xml_path.write_bytes(content)
-
         # # Always write debug info
         # with debug_path.open("w", encoding="utf-8") as f:
         #     f.write(f"URL: {r.url}\n")
@@ -149,8 +301,18 @@ def download_invoice_xml(sef_id, invoice_type):
         #         f.write(repr(content[:500]))
 
         # Fail loudly if SEF returned junk
-        if r.status_code != 200 or len(content) < 50:
-            raise Exception("SEF returned empty or invalid XML")
+        if r.status_code >= 500 or r.status_code == 429:
+            raise SefTransientError(f"SEF returned HTTP {r.status_code}")
+        if r.status_code != 200:
+            raise WebhookPermanentError(f"SEF returned HTTP {r.status_code}")
+        if len(content) < 50:
+            raise SefTransientError("SEF returned empty or invalid XML")
+
+        # Only a valid answer lands in sef_tmp (junk would be re-used on retry);
+        # write + rename so concurrent readers never see a partial file.
+        part_path = xml_path.with_name(xml_path.name + ".part")
+        part_path.write_bytes(content)
+        part_path.replace(xml_path)
 
         return xml_path
 
@@ -161,59 +323,72 @@ def download_invoice_xml(sef_id, invoice_type):
             f.write(traceback.format_exc())
         raise
 
-def get_or_create_invoice(sef_id, invoice_type, extracted):
-
-    lookup = (
-        {"purchaseInvoiceId": sef_id}
-        if invoice_type == "ulazne"
-        else {"salesInvoiceId": sef_id}
-    )
-
-    doc = Dokumenti.objects.filter(**lookup).first()
-    if doc:
-        return doc, False
-    header = extracted["header"]
+def partner_from_xml(invoice_type, extracted):
+    """Client fields of the other party: supplier for ulazne, customer for izlazne."""
     invoice = extracted["invoice"]
-
     partner = (
         invoice["Supplier"]
         if invoice_type == "ulazne"
         else invoice["Customer"]
     )
-
-    client = get_or_create_client_from_xml({
-        "pib": partner.get("PIB"),
+    return {
+        # the customer's tax id is extracted as CompanyID
+        "pib": partner.get("PIB") or partner.get("CompanyID"),
         "ime": partner.get("Name"),
         "mbr": partner.get("MBR"),
         "adresa": partner.get("Address"),
-    })
+    }
 
-    doc = Dokumenti.objects.create(
+def build_invoice(invoice_type, extracted, klijent_id):
+    """Unsaved Dokumenti for an extracted SEF invoice."""
+    header = extracted["header"]
+    invoice = extracted["invoice"]
+
+    return Dokumenti(
         dok_tip="ULF" if invoice_type == "ulazne" else "IZF",
         dok_br=invoice.get("ID"),
         val_datum=invoice.get("DueDate"),
-        valuta=invoice.get("DocumentCurrencyCode"),
+        valuta=invoice.get("DocumentCurrencyCode") or "RSD",
         iznos_P=Decimal(invoice.get("PayableAmount", "0")),
         status_dok=True,
         salesInvoiceId=header.get("SalesInvoiceId") if invoice_type == "izlazne" else None,
         purchaseInvoiceId=header.get("PurchaseInvoiceId") if invoice_type == "ulazne" else None,
-        klijent_id=client,
+        klijent_id=klijent_id,
         dok_datum=invoice.get("IssueDate"),
-        prm_datum=invoice.get("ActualDeliveryDate"),
+        prm_datum=invoice.get("ActualDeliveryDate") or invoice.get("IssueDate"),
         efaktura=True,
     )
 
+def get_or_create_invoice(sef_id, invoice_type, extracted):
+
+    lookup = (
+        {"purchaseInvoiceId": sef_id}
+        if invoice_type == "ulazne"
+        else {"salesInvoiceId": sef_id}
+    )
+
+    doc = Dokumenti.objects.filter(**lookup).first()
+    if doc:
+        return doc, False
+
+    client = get_or_create_client_from_xml(partner_from_xml(invoice_type, extracted))
+
+    doc = build_invoice(invoice_type, extracted, client)
+    doc.save(force_insert=True)
+
     return doc, True
 
 def attach_xml_if_missing(doc, xml_path):
     if doc.file:
         return
 
-    with open(xml_path, "rb") as f:
-        doc.file.save(xml_path.name, File(f), save=False)
-
+    # content-addressed: a re-downloaded XML resolves to the existing blob
+    doc.file.name = doc.file.storage.save_local(xml_path, link=True)
     doc.save(update_fields=["file"])
 
+    # the sef_tmp copy is only needed until the document is committed
+    transaction.on_commit(lambda: Path(xml_path).unlink(missing_ok=True))
+
 UNIT_MAP = {
     "H87": "H87",  # kom
     "HUR": "HUR",  # hour
@@ -223,66 +398,65 @@ UNIT_MAP = {
 def map_unit(unit_code):
     return UNIT_MAP.get(unit_code, "H87")  # safe default
 
-def insert_items(doc, invoice_type, extracted):
+ITEM_MODELS = {
+    # invoice_type: (model, FK field, tip_prometa)
+    "izlazne": (FakturaStavka, "faktura", "U"),
+    "ulazne": (UlaznaFakturaStavka, "ulazna_faktura", "P"),
+}
 
-    # Determine model + FK field
-    if invoice_type == "izlazne":
-        if doc.stavke_izf.exists():
-            return
-        Model = FakturaStavka
-        fk_field = "faktura"
-        tip_prometa = "U"
+def build_items(doc, invoice_type, extracted):
+    """Unsaved item rows of an extracted SEF invoice for `doc`."""
+    Model, fk_field, tip_prometa = ITEM_MODELS[invoice_type]
+    return [
+        Model(
+            **{
+                fk_field: doc,
+                "naziv": line.get("ItemName"),
+                "kolicina": Decimal(line.get("InvoicedQuantity", "1")),
+                "cena": Decimal(line.get("PriceAmount", "0")),
+                "jed_mere": map_unit(line.get("UnitCode")),
+                "tip_prometa": tip_prometa,
+            }
+        )
+        for line in extracted["lines"]
+    ]
 
-    elif invoice_type == "ulazne":
-        if doc.stavke_ulf.exists():
-            return
-        Model = UlaznaFakturaStavka
-        fk_field = "ulazna_faktura"
-        tip_prometa = "P"
+def insert_items(doc, invoice_type, extracted):
 
-    else:
+    if invoice_type not in ITEM_MODELS:
         return  # safety
 
-    items = []
-
-    for line in extracted["lines"]:
-        items.append(
-            Model(
-                **{
-                    fk_field: doc,
-                    "naziv": line.get("ItemName"),
-                    "kolicina": Decimal(line.get("InvoicedQuantity", "1")),
-                    "cena": Decimal(line.get("PriceAmount", "0")),
-                    "jed_mere": map_unit(line.get("UnitCode")),
-                    "tip_prometa": tip_prometa,
-                }
-            )
-        )
+    Model, fk_field, _ = ITEM_MODELS[invoice_type]
+    if Model.objects.filter(**{fk_field: doc}).exists():
+        return
+
+    Model.objects.bulk_create(build_items(doc, invoice_type, extracted))
 
-    Model.objects.bulk_create(items)
 
+def normalize_pib(rspib):
+    """SEF tax ids carry the country prefix (RS123456789) — keep the 9 digits."""
+    return rspib[-9:] if len(rspib) > 9 else rspib
 
+def new_client_from_xml(client_data):
+    # the id comes from the database: explicit ids would leave a PostgreSQL
+    # sequence behind and break the next client saved from the form
+    return Klijenti(
+        ime=client_data["ime"],
+        pib=normalize_pib(client_data["pib"]),
+        mbr=client_data.get("mbr") or "",
+        adresa=client_data.get("adresa") or "",
+        defcode=13,
+    )
 
 def get_or_create_client_from_xml(client_data):
-    rspib = client_data["pib"]
-    pib = rspib[-9:] if len(rspib) > 9 else rspib
+    pib = normalize_pib(client_data["pib"])
 
     client = Klijenti.objects.select_for_update().filter(pib=pib).first()
 
     if client:
         return client.id
 
-    next_id = (
-        Klijenti.objects.aggregate(m=Max("id"))["m"] or 0
-    ) + 1
-
-    client = Klijenti.objects.create(
-        id=next_id,
-        ime=client_data["ime"],
-        pib=pib,
-        mbr=client_data.get("mbr"),
-        adresa=client_data.get("adresa"),
-        defcode=13,
-    )
+    client = new_client_from_xml(client_data)
+    client.save(force_insert=True)
 
-    return client
\ No newline at end of file
+    return client.id
\ No newline at end of file
@@ -0,0 +1,294 @@
+# gtbook/utils/webhook_worker.py
+import logging
+import os
+import socket
+import threading
+import traceback
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, transaction
+from django.db.models import Q
+from django.utils import timezone
+
+from gtbook.models import WebhookEvent, WebhookLog
+from gtbook.utils.log import log_event, log_stage
+from gtbook.utils.webhook_processing import (
+    WebhookPermanentError, coalesce_events, drop_superseded, prefetch_invoice_xml,
+    process_invoice_event,
+)
+
+logger = logging.getLogger(__name__)
+
+WORKER_MODES = ("thread", "process")
+
+DEFAULT_LEASE_SECONDS = 300   # must comfortably exceed the SEF download timeout
+
+# Delay before the n-th retry. An event that still fails after the last step
+# (or fails permanently) is moved to the dead-letter state.
+RETRY_BACKOFF_SECONDS = (30, 120, 600, 1800, 3600, 6 * 3600)
+
+
+def schedule_retry(webhook, exc, error):
+    """Record a failed attempt and either schedule the next one or give up."""
+    attempts = webhook.attempts + 1
+    fields = {
+        "attempts": attempts,
+        "error": error,
+        "claimed_at": None,
+        "claimed_by": None,
+    }
+    if isinstance(exc, WebhookPermanentError) or attempts > len(RETRY_BACKOFF_SECONDS):
+        fields["status"] = "dead"
+        fields["next_attempt_at"] = None
+        logger.warning("event=webhook.dead webhook_id=%s attempts=%s error=%r",
+                       webhook.id, attempts, exc)
+    else:
+        delay = RETRY_BACKOFF_SECONDS[attempts - 1]
+        fields["next_attempt_at"] = timezone.now() + timedelta(seconds=delay)
+        logger.info("event=webhook.retry webhook_id=%s attempts=%s delay_s=%s error=%r",
+                    webhook.id, attempts, delay, exc)
+
+    WebhookEvent.objects.filter(id=webhook.id).update(**fields)
+
+
+def revive_dead_events():
+    """Put dead-lettered events back into the queue with a fresh retry budget."""
+    return WebhookEvent.objects.filter(status="dead").update(
+        status="pending", attempts=0, next_attempt_at=None
+    )
+
+
+def handle_invoice_group(group):
+    """
+    Process one coalesced invoice group in isolation from the rest of the
+    batch. Returns (webhook_ids, success, exception, traceback) — exceptions
+    never escape, so one bad SEF payload can't stop the other events.
+    """
+    try:
+        process_invoice_event(group)
+    except Exception as e:
+        return group["webhook_ids"], False, e, traceback.format_exc()
+    return group["webhook_ids"], True, None, None
+
+
+def _pool_task(group):
+    # Each pool thread/process opens its own DB connection — close it after
+    # every group so idle workers don't keep connections (and locks) around.
+    try:
+        return handle_invoice_group(group)
+    finally:
+        connections.close_all()
+
+
+def _init_process_worker():
+    # Needed for the "spawn" start method (Windows); a no-op after fork.
+    import django
+    from django.apps import apps
+
+    if not apps.ready:
+        django.setup()
+
+
+def _release_connections():
+    # Forked children must not share the parent's DB connection, nor its
+    # psycopg pool (DB_ENGINE=postgres) whose sockets and threads belong to
+    # the parent. Closing them here, before the executor forks, is the only
+    # safe place: a child closing the inherited pool would terminate the
+    # parent's sessions. The parent reopens the pool on its next query.
+    connections.close_all()
+    for connection in connections.all(initialized_only=True):
+        if hasattr(connection, "close_pool"):
+            connection.close_pool()
+
+
+def make_executor(workers, mode="thread"):
+    if mode not in WORKER_MODES:
+        raise ValueError(f"Unknown worker mode: {mode}")
+    if mode == "process":
+        return ProcessPoolExecutor(max_workers=workers, initializer=_init_process_worker)
+    return ThreadPoolExecutor(max_workers=workers, thread_name_prefix="webhook")
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def claim_batch(worker_id, batch_size, lease_seconds=DEFAULT_LEASE_SECONDS, after_id=0):
+    """
+    Claim up to `batch_size` events (with id > `after_id`) for `worker_id`
+    and return their ids.
+    Pending events that are due (next_attempt_at reached) and not leased
+    by a live worker are claimable.
+    The conditional UPDATE makes claiming safe with several workers even
+    where SELECT ... FOR UPDATE is not supported (SQLite).
+    """
+    now = timezone.now()
+    claimable = (
+        Q(status="pending")
+        & (Q(next_attempt_at__isnull=True) | Q(next_attempt_at__lte=now))
+        & (Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=lease_seconds)))
+    )
+
+    with transaction.atomic():
+        ids = list(
+            WebhookEvent.objects.select_for_update(skip_locked=True)
+            .filter(claimable, id__gt=after_id)
+            .order_by("id")
+            .values_list("id", flat=True)[:batch_size]
+        )
+        if not ids:
+            return []
+        WebhookEvent.objects.filter(claimable, id__in=ids).update(
+            claimed_at=now, claimed_by=worker_id
+        )
+
+    claimed = list(
+        WebhookEvent.objects.filter(id__in=ids, claimed_by=worker_id, claimed_at=now)
+        .order_by("id")
+        .values_list("id", flat=True)
+    )
+    log_event(logger, "webhook.claimed", worker=worker_id, events=len(claimed))
+    return claimed
+
+
+def run_batch(ids, executor=None, mode="thread"):
+    """
+    Process one batch of claimed event ids, serially or on the given executor.
+    Events are coalesced per invoice first, so a burst of status changes for
+    one invoice costs a single document update and log entry. Missing SEF
+    XMLs are then downloaded in parallel, so processing only reads local files.
+    Returns [(webhook_id, success, error)].
+    """
+    with log_stage(logger, "webhook.batch", events=len(ids)) as stage:
+        outcome = _run_batch(ids, executor, mode, stage.fields)
+    return outcome
+
+
+def _run_batch(ids, executor, mode, counters):
+    webhooks = list(WebhookEvent.objects.filter(id__in=ids).order_by("id"))
+    groups, invalid = coalesce_events(webhooks)
+    # already overtaken by a newer event applied in an earlier batch: done
+    groups, superseded = drop_superseded(groups)
+    counters["groups"] = len(groups)
+    counters["superseded"] = len(superseded)
+
+    results = []
+    download_errors = prefetch_invoice_xml(groups, settings.SEF_PREFETCH_WORKERS)
+    if download_errors:
+        for group in groups:
+            exc = download_errors.get((group["invoice_type"], group["sef_id"]))
+            if exc is not None:
+                error = "".join(traceback.format_exception(exc))
+                results.append((group["webhook_ids"], False, exc, error))
+        failed_keys = set(download_errors)
+        groups = [g for g in groups if (g["invoice_type"], g["sef_id"]) not in failed_keys]
+
+    if executor is None:
+        results += [handle_invoice_group(group) for group in groups]
+    else:
+        if mode == "process":
+            _release_connections()
+        results += list(executor.map(_pool_task, groups))
+
+    # A row succeeds only if every invoice group it contributed to succeeded
+    failures = {
+        webhook_id: (exc, "".join(traceback.format_exception(exc)))
+        for webhook_id, exc in invalid.items()
+    }
+    for webhook_ids, success, exc, error in results:
+        if not success:
+            for webhook_id in webhook_ids:
+                failures.setdefault(webhook_id, (exc, error))
+
+    done = [webhook.id for webhook in webhooks if webhook.id not in failures]
+    WebhookEvent.objects.filter(id__in=done).delete()
+
+    outcome = []
+    for webhook in webhooks:
+        if webhook.id in failures:
+            exc, error = failures[webhook.id]
+            schedule_retry(webhook, exc, error)
+            outcome.append((webhook.id, False, error))
+        else:
+            outcome.append((webhook.id, True, None))
+    counters["failed"] = len(failures)
+    return outcome
+
+
+def _tally(results, counts, on_result):
+    for result in results:
+        counts[0 if result[1] else 1] += 1
+        if on_result:
+            on_result(*result)
+
+
+def process_pending(workers=1, mode="thread", batch_size=50, on_result=None,
+                    worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS):
+    """
+    Drain all claimable webhook events once. With workers > 1 each batch is
+    handled in parallel by a thread or process pool. Each event is attempted
+    at most once per run.
+    Returns (processed, failed).
+    """
+    worker_id = worker_id or default_worker_id()
+    counts = [0, 0]
+    last_id = 0
+    executor = make_executor(workers, mode) if workers > 1 else None
+
+    try:
+        while True:
+            ids = claim_batch(worker_id, batch_size, lease_seconds, after_id=last_id)
+            if not ids:
+                break
+            last_id = ids[-1]
+            _tally(run_batch(ids, executor, mode), counts, on_result)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    if counts[0]:
+        WebhookLog.trim()
+
+    return tuple(counts)
+
+
+def run_daemon(stop_event=None, workers=1, mode="thread", batch_size=50, on_result=None,
+               worker_id=None, lease_seconds=DEFAULT_LEASE_SECONDS,
+               poll_interval=1.0, max_poll_interval=30.0):
+    """
+    Keep claiming and processing events until `stop_event` is set.
+    When there is nothing to do the poll interval doubles up to
+    `max_poll_interval` and resets as soon as new events arrive.
+    """
+    stop_event = stop_event or threading.Event()
+    worker_id = worker_id or default_worker_id()
+    counts = [0, 0]
+    delay = poll_interval
+    busy = False
+    executor = make_executor(workers, mode) if workers > 1 else None
+
+    try:
+        while not stop_event.is_set():
+            ids = claim_batch(worker_id, batch_size, lease_seconds)
+            if ids:
+                _tally(run_batch(ids, executor, mode), counts, on_result)
+                delay = poll_interval
+                busy = True
+                continue
+
+            if busy:
+                # queue just drained — good moment for log retention
+                WebhookLog.trim()
+                busy = False
+
+            # idle: don't keep the DB connection open while sleeping
+            connections.close_all()
+            stop_event.wait(delay)
+            delay = min(delay * 2, max_poll_interval)
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    return tuple(counts)
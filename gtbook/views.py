@@ -1,34 +1,39 @@
 import base64
 from calendar import monthrange
+from collections import defaultdict
 from pathlib import Path
-import json, logging, traceback, requests
+import json, logging, mimetypes, traceback, requests
 from django.apps import apps
 from django.contrib.auth.decorators import login_required
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib import messages
-from django.forms import inlineformset_factory
 from django.shortcuts import render, redirect, get_object_or_404
 from django.urls import reverse
 from gtbook.management.commands import process_webhooks
 from gtbook.templatetags.slovima import iznos_slovima
 from gtbook.utils.sef_status import get_sef_subscription_status
-from gtbook.utils.services import attach_otpremnice_to_faktura
-from .models import Klijenti, Dokumenti, FakturaStavka, OtpremnicaStavka, UlaznaFakturaStavka, DEF_OPT, WebhookEvent, WebhookLog
-from .forms import ClientForm, DokumentForm, DokumentStavkeForm
+from gtbook.utils.services import STAVKE_MODELS, attach_otpremnice_to_faktura, clone_items, negate_kolicina, recalc_totals
+from .models import Klijenti, Dokumenti, FakturaStavka, OtpremnicaStavka, UlaznaFakturaStavka, DEF_OPT, DEF_SEF, WebhookEvent, WebhookLog
+from .forms import ClientForm, DokumentForm, get_stavke_formset
 from django.utils.timezone import now, localdate, timedelta, make_aware, datetime as dt
 from django.db.models.functions import TruncMonth
 from django.db.models import Q, Count, F, ExpressionWrapper, BooleanField, Sum
 from django.db import IntegrityError, transaction
 from datetime import date, datetime, timezone
 from django.conf import settings
-from django.http import JsonResponse, Http404, HttpResponse
+from django.http import JsonResponse, Http404, HttpResponse, StreamingHttpResponse
+from django.utils.html import format_html_join
+from django.utils.http import content_disposition_header
+from django.utils.safestring import mark_safe
 from django.template.loader import render_to_string
 from django.views.decorators.http import require_GET, require_POST
 from django.views.decorators.csrf import csrf_exempt
 from .utils.api_calls import get_company_accounts, parse_company_accounts, check_pib_in_sef, sef_send_storno
-from .utils.utils import next_dok_number, filter_klijenti_by_tip_sqlite, format_qty
+from .utils.utils import next_dok_number, reserve_dok_number, filter_klijenti_by_tip, format_qty
 from .utils.xml_export import generate_invoice_xml
 from .utils.pdf import render_pdf_to_response
+from .utils.blob_store import COMPRESSION_SUFFIXES, compression_of
+from .utils.webhook_ingest import WebhookIngestError, aingest_webhook_events, normalize_payload
 from django.core.management import call_command
 import pdfkit
 
@@ -153,15 +158,8 @@ def dokument_storno(original: Dokumenti) -> Dokumenti:
     )
 
     # --- Copy & negate invoice items ---
-    for stavka in original.stavke_izf.all():
-        FakturaStavka.objects.create(
-            faktura=storno,
-            naziv=stavka.naziv,
-            tip_prometa=stavka.tip_prometa,
-            kolicina=-stavka.kolicina,
-            cena=stavka.cena,
-            jed_mere=stavka.jed_mere,
-        )
+    clone_items(original.stavke_izf.all(), storno, transform=negate_kolicina)
+
     # --- SEND TO SEF ---
     response = sef_send_storno(
         invoice_id=original.salesInvoiceId,
@@ -388,8 +386,8 @@ def dokument_create_empty(request, tip):
     }
 
     # Filter clients
-    klijenti = filter_klijenti_by_tip_sqlite(tip).annotate(
-        sef_flag=ExpressionWrapper(F('defcode').bitand(4), output_field=BooleanField())
+    klijenti = filter_klijenti_by_tip(tip).annotate(
+        sef_flag=ExpressionWrapper(Q(defcode__bitand=DEF_SEF), output_field=BooleanField())
     )
 
     if request.method == "POST":
@@ -400,11 +398,12 @@ def dokument_create_empty(request, tip):
         if form.is_valid():
             dok = form.save(commit=False)
             dok.dok_tip = tip
-            dok.dok_br = next_dok_number(tip)
 
             # Auto val_datum
             dok.val_datum = dok.prm_datum + timedelta(days=30) if dok.prm_datum else None
-            dok.save()
+            with transaction.atomic():
+                dok.dok_br = reserve_dok_number(tip)
+                dok.save()
 
             messages.success(
                 request,
@@ -435,36 +434,11 @@ def dokument_create_empty(request, tip):
 
 @login_required
 def dokument_create(request, tip):
-    # Choose correct ItemModel and related names for this tip
-    if tip == "IZF":
-        ItemModel = FakturaStavka
-        related_name = "stavke_izf"
-        fk_name = "faktura"
-    elif tip == "OTP":
-        ItemModel = OtpremnicaStavka
-        related_name = "stavke_otp"
-        fk_name = "otpremnica"
-    elif tip == "ULF":
-        ItemModel = UlaznaFakturaStavka
-        related_name = "stavke_ulf"
-        fk_name = "ulazna_faktura"
-    else:
+    FormSetClass = get_stavke_formset(tip, "create")  # one empty row for create
+    if FormSetClass is None:
         messages.error(request, "Unknown document type")
         return redirect("dokument_list")
-
-    # Build a form class for this item model (keeps your DokumentStavkeForm widgets/validation)
-    # StavkaForm = get_stavka_form(tip)
-
-    # Create a FormSet class for this tip. For create we want one empty row by default.
-    FormSetClass = inlineformset_factory(
-        parent_model=Dokumenti,
-        model=ItemModel,
-        form=DokumentStavkeForm,
-        fk_name=fk_name,
-        fields=["tip_prometa", "naziv", "kolicina", "jed_mere", "cena"],
-        extra=1,   # one empty row for create
-        can_delete=True,
-    )
+    ItemModel, fk_name = STAVKE_MODELS[tip]
 
     client = None
     today = now().strftime("%d.%m.%Y")
@@ -490,8 +464,8 @@ def dokument_create(request, tip):
         except Klijenti.DoesNotExist:
             client = None
 
-    klijenti = filter_klijenti_by_tip_sqlite(tip).annotate(
-        sef_flag=ExpressionWrapper(F('defcode').bitand(4), output_field=BooleanField())
+    klijenti = filter_klijenti_by_tip(tip).annotate(
+        sef_flag=ExpressionWrapper(Q(defcode__bitand=DEF_SEF), output_field=BooleanField())
     )
 
     if request.method == "POST":
@@ -558,17 +532,17 @@ def dokument_create(request, tip):
                     }
                     return render(request, "dokument_form.html", context)
 
-        # Generate document number if needed
-        if tip in ["IZF", "OTP"]:
-            dok.dok_br = next_dok_number(tip)
-
         # Auto-calculate val_datum if not OTP
         if tip != 'OTP' and dok.prm_datum:
             dok.val_datum = dok.prm_datum + timedelta(days=30)
         else:
             dok.val_datum = None
 
-        dok.save()
+        with transaction.atomic():
+            # Generate document number if needed
+            if tip in ["IZF", "OTP"]:
+                dok.dok_br = reserve_dok_number(tip)
+            dok.save()
 
         # Now bind formset to the saved dokument and persist items
         formset.instance = dok
@@ -580,17 +554,8 @@ def dokument_create(request, tip):
                 )
             formset.save()
 
-        # --- Sum and update totals --- (use correct related_name)
-        iznos_P = iznos_U = 0
-        for item in getattr(dok, related_name).all():
-            if item.tip_prometa == "P":
-                iznos_P += item.cena * item.kolicina
-            elif item.tip_prometa == "U":
-                iznos_U += item.cena * item.kolicina
-
-        dok.iznos_P = iznos_P
-        dok.iznos_U = iznos_U
-        dok.save(update_fields=["iznos_P", "iznos_U"])
+        # --- Sum and update totals ---
+        recalc_totals(dok)
 
         print(request, f"{dict(Dokumenti.TIPOVI_DOK).get(tip, tip)} #{dok.dok_br} uspešno kreirana.")
         messages.success(request, f"{dict(Dokumenti.TIPOVI_DOK).get(tip, tip)} #{dok.dok_br} uspešno kreirana.")
@@ -604,24 +569,15 @@ def dokument_create(request, tip):
                         dok_datum=dok.dok_datum,
                         prm_datum=dok.prm_datum,
                         klijent=dok.klijent,
-                        dok_br=next_dok_number("OTP"),
+                        dok_br=reserve_dok_number("OTP"),
                         napomena=f"Automatski kreirana otpremnica za {dok.dok_tip} #{dok.dok_br}",
                         val_datum=None,
-                        iznos_U=iznos_U,
-                        iznos_P=iznos_P,
+                        iznos_U=dok.iznos_U,
+                        iznos_P=dok.iznos_P,
                         faktura=dok,  # link Otpremnica → Faktura
                     )
-                    # Duplicate the items from original document (use related_name)
-                    for item in getattr(dok, related_name).all():
-                        # create OtpremnicaStavka objects attached to otp
-                        OtpremnicaStavka.objects.create(
-                            otpremnica=otp,
-                            naziv=item.naziv,
-                            tip_prometa=item.tip_prometa,
-                            kolicina=item.kolicina,
-                            cena=item.cena,
-                            jed_mere=item.jed_mere,
-                        )
+                    # Duplicate the items from original document
+                    clone_items(ItemModel.objects.filter(**{fk_name: dok}), otp)
                     print(request, f"Otpremnica #{otp.dok_br} automatski kreirana.")
                     messages.success(request, f"Otpremnica #{otp.dok_br} automatski kreirana.")
             except Exception as e:
@@ -676,6 +632,30 @@ def dokument_create(request, tip):
 #         }
 #     )
 
+def set_otp_previews(otpremnice):
+    """
+    Set `otp.preview` (tooltip HTML listing the items) on every otpremnica,
+    with one query for the items of all of them.
+    """
+    items = defaultdict(list)
+    rows = (
+        OtpremnicaStavka.objects.filter(otpremnica__in=[otp.id for otp in otpremnice])
+        .order_by("id")
+        .values_list("otpremnica_id", "naziv", "kolicina", "jed_mere", "cena")
+    )
+    for otp_id, *row in rows:
+        items[otp_id].append(row)
+
+    jed_mere = dict(OtpremnicaStavka.JEDINICE_MERE)
+    for otp in otpremnice:
+        otp.preview = format_html_join(
+            mark_safe("<br>"), "{} – {} {} × {}",
+            (
+                (naziv, format_qty(kolicina), jed_mere.get(jm, jm), cena)
+                for naziv, kolicina, jm, cena in items[otp.id]
+            ),
+        )
+
 @login_required
 def dokument_edit(request, pk):
     try:
@@ -686,33 +666,11 @@ def dokument_edit(request, pk):
 
     tip = dok.dok_tip  # preserve type
 
-    # Choose correct ItemModel and fk_name / related_name
-    if tip == "IZF":
-        ItemModel = FakturaStavka
-        fk_name = "faktura"
-        related_name = "stavke_izf"
-    elif tip == "OTP":
-        ItemModel = OtpremnicaStavka
-        fk_name = "otpremnica"
-        related_name = "stavke_otp"
-    elif tip == "ULF":
-        ItemModel = UlaznaFakturaStavka
-        fk_name = "ulazna_faktura"
-        related_name = "stavke_ulf"
-    else:
+    FormSetClass = get_stavke_formset(tip, "edit")
+    if FormSetClass is None:
         messages.error(request, "Unknown document type")
         return redirect("dokument_list")
-
-    # Build formset for edit
-    FormSetClass = inlineformset_factory(
-        parent_model=Dokumenti,
-        model=ItemModel,
-        form=DokumentStavkeForm,
-        fk_name=fk_name,
-        fields=["tip_prometa", "naziv", "kolicina", "jed_mere", "cena"],
-        extra=0,
-        can_delete=True,
-    )
+    ItemModel, fk_name = STAVKE_MODELS[tip]
 
     if request.method == "POST":
         form = DokumentForm(request.POST, request.FILES, instance=dok)
@@ -728,17 +686,8 @@ def dokument_edit(request, pk):
                 if otpremnice_ids:
                     attach_otpremnice_to_faktura(dok, otpremnice_ids)
 
-            # --- Sum and update totals (use correct related_name) ---
-            iznos_P = iznos_U = 0
-            for item in getattr(dok, related_name).all():
-                if item.tip_prometa == "P":
-                    iznos_P += item.cena * item.kolicina
-                elif item.tip_prometa == "U":
-                    iznos_U += item.cena * item.kolicina
-
-            dok.iznos_P = iznos_P
-            dok.iznos_U = iznos_U
-            dok.save(update_fields=["iznos_P", "iznos_U"])
+            # --- Sum and update totals ---
+            recalc_totals(dok)
 
             messages.success(
                 request,
@@ -755,24 +704,15 @@ def dokument_edit(request, pk):
                             dok_datum=dok.dok_datum,
                             prm_datum=dok.prm_datum,
                             klijent=dok.klijent,
-                            dok_br=next_dok_number("OTP"),
+                            dok_br=reserve_dok_number("OTP"),
                             napomena=f"Automatski kreirana otpremnica za {dok.dok_tip} #{dok.dok_br}",
                             val_datum=None,
-                            iznos_U=iznos_U,
-                            iznos_P=iznos_P,
+                            iznos_U=dok.iznos_U,
+                            iznos_P=dok.iznos_P,
                             faktura=dok,  # link Otpremnica → Faktura
                         )
-                        # Duplicate the items from original document (use related_name)
-                        for item in getattr(dok, related_name).all():
-                            # create OtpremnicaStavka objects attached to otp
-                            OtpremnicaStavka.objects.create(
-                                otpremnica=otp,
-                                naziv=item.naziv,
-                                tip_prometa=item.tip_prometa,
-                                kolicina=item.kolicina,
-                                cena=item.cena,
-                                jed_mere=item.jed_mere,
-                            )
+                        # Duplicate the items from original document
+                        clone_items(ItemModel.objects.filter(**{fk_name: dok}), otp)
                         print(request, f"Otpremnica #{otp.dok_br} automatski kreirana.")
                         messages.success(request, f"Otpremnica #{otp.dok_br} automatski kreirana.")
                 except Exception as e:
@@ -786,32 +726,26 @@ def dokument_edit(request, pk):
     else:
         form = DokumentForm(instance=dok)
         formset = FormSetClass(instance=dok)
-        linked_otps = dok.otpremnice.all() if dok.dok_tip == "IZF" else []
-
-        for otp in linked_otps:
-            otp.preview = "<br>".join(
-                f"{item.naziv} – {format_qty(item.kolicina)} {item.get_jed_mere_display()} × {item.cena}"
-                for item in otp.stavke_otp.all()
-            )
 
     # Filter clients
-    klijenti = filter_klijenti_by_tip_sqlite(tip).annotate(
-        sef_flag=ExpressionWrapper(F('defcode').bitand(4), output_field=BooleanField())
+    klijenti = filter_klijenti_by_tip(tip).annotate(
+        sef_flag=ExpressionWrapper(Q(defcode__bitand=DEF_SEF), output_field=BooleanField())
     )
     form.fields['klijent'].queryset = klijenti
 
-    # Filter available otpremnice (only unlinked, same client)
-    available_otpremnice = Dokumenti.objects.filter(
-        dok_tip='OTP',
-        faktura__isnull=True,
-        klijent=dok.klijent
-    )
-
-    for otp in available_otpremnice:
-            otp.preview = "<br>".join(
-                f"{item.naziv} – {format_qty(item.kolicina)} {item.get_jed_mere_display()} × {item.cena}"
-                for item in otp.stavke_otp.all()
-            )
+    linked_otps = available_otpremnice = []
+    if tip == "IZF":
+        otp_fields = ("id", "dok_br", "dok_datum", "faktura")
+        linked_otps = list(dok.otpremnice.only(*otp_fields))
+        # Filter available otpremnice (only unlinked, same client)
+        available_otpremnice = list(
+            Dokumenti.objects.filter(
+                dok_tip='OTP',
+                faktura__isnull=True,
+                klijent=dok.klijent
+            ).only(*otp_fields)
+        )
+        set_otp_previews(linked_otps + available_otpremnice)
 
     return render(request, 'dokument_form.html', {
         'form': form,
@@ -830,8 +764,8 @@ logger = logging.getLogger(__name__)
 @login_required
 def unlink_otp_from_izf(request, izf_id, otp_id):
     """
-    Unlink OTP (otp_id) from IZF (izf_id). Also remove from the IZF any FakturaStavka
-    rows that appear to originate from that OTP (match by naziv, kolicina, cena, jed_mere).
+    Unlink OTP (otp_id) from IZF (izf_id). Also remove from the IZF the
+    FakturaStavka rows that were copied from that OTP (FakturaStavka.source_otp).
     """
     # Load documents and verify types / relation
     izf = get_object_or_404(Dokumenti, pk=izf_id, dok_tip="IZF")
@@ -850,25 +784,12 @@ def unlink_otp_from_izf(request, izf_id, otp_id):
         otp.faktura = None
         otp.save(update_fields=["faktura"])
 
-        # gather OTP items
-        otp_items = OtpremnicaStavka.objects.filter(otpremnica=otp)
-
-        # build a filter for faktura items to delete
-        # match by naziv, kolicina, cena, jed_mere — this is what we used before
-        deleted_count = 0
-        for item in otp_items:
-            qs = FakturaStavka.objects.filter(
-                faktura=izf,
-                naziv=item.naziv,
-                kolicina=item.kolicina,
-                cena=item.cena,
-                jed_mere=item.jed_mere
-            )
-            # count removed per item (may remove multiple identical rows)
-            cnt = qs.count()
-            if cnt:
-                qs.delete()
-                deleted_count += cnt
+        # one DELETE for every invoice item copied from this otpremnica
+        deleted_count, _ = FakturaStavka.objects.filter(
+            faktura=izf, source_otp__otpremnica=otp
+        ).delete()
+
+        recalc_totals(izf)
 
         messages.success(request, f"Otpremnica odvojena. Uklonjeno stavki: {deleted_count}")
         logger.info("Otpremnica %s odvojena od fakture %s — uklonjeno %d stavki fakture",
@@ -894,21 +815,10 @@ def link_otp_to_izf(request, izf_id, otp_id):
         otp.faktura = izf
         otp.save(update_fields=["faktura"])
 
-        # collect items that will be inserted into formset immediately
-        otp_items = OtpremnicaStavka.objects.filter(otpremnica=otp)
-
-        copied_count = 0
-        for item in otp_items:
-            # Create FakturaStavka copy
-            FakturaStavka.objects.create(
-                faktura=izf,
-                tip_prometa=item.tip_prometa,
-                naziv=item.naziv,
-                kolicina=item.kolicina,
-                jed_mere=item.jed_mere,
-                cena=item.cena,
-            )
-            copied_count += 1
+        # copy the items into the invoice
+        copied_count = len(clone_items(otp.stavke_otp.all(), izf))
+
+        recalc_totals(izf)
 
         messages.success(request, f"Otpremnica povezana. Kopirano stavki: {copied_count}")
         logger.info("Otpremnica %s povezana sa fakturom %s — kopirano %d stavki",
@@ -932,16 +842,8 @@ def dokument_delete(request, pk):
         
     return JsonResponse({"success": False, "message": "Nevažeći zahtev."}, status=400)
 
-@login_required
-def dokument_list(request): #def dokument_list(request, doc_type=None):
-    # Make a mutable copy of GET parameters
-    params = request.GET.copy()
-
-    # Default doc_type = IZF
-    if not params.get('doc_type'):
-        params['doc_type'] = 'IZF'
-
-    # Filters
+def filter_dokumenti(params):
+    """Dokumenti matching the dokument_list filters (doc_type must be set)."""
     doc_type = params.get("doc_type")
     client_id = params.get("client")
     date_from = params.get("date_from")
@@ -949,13 +851,7 @@ def dokument_list(request): #def dokument_list(request, doc_type=None):
     status_fak = params.get("status_fak")
     status_SEF = params.get("status_SEF")
 
-    # Default dates: Jan 1 current year → today
-    today = date.today()
-    default_date_from = date(today.year, 1, 1).strftime("%d.%m.%Y")
-    default_date_to = today.strftime("%d.%m.%Y")
-
-    # Base queryset
-    docs = Dokumenti.objects.all().select_related("klijent")
+    docs = Dokumenti.objects.all()
 
     # Apply filters
     if doc_type:
@@ -980,30 +876,121 @@ def dokument_list(request): #def dokument_list(request, doc_type=None):
         docs = docs.filter(status_fak=status_fak)
     if status_SEF:
         docs = docs.filter(status_SEF=status_SEF)
+    return docs
+
+@login_required
+def dokument_list(request): #def dokument_list(request, doc_type=None):
+    # Make a mutable copy of GET parameters
+    params = request.GET.copy()
 
-    # Calculate total per document
-    for d in docs:
-        d.total = float(d.iznos_P or 0) + float(d.iznos_U or 0)
+    # Default doc_type = IZF
+    if not params.get('doc_type'):
+        params['doc_type'] = 'IZF'
 
+    # Default dates: Jan 1 current year → today
+    today = date.today()
+    default_date_from = date(today.year, 1, 1).strftime("%d.%m.%Y")
+    default_date_to = today.strftime("%d.%m.%Y")
+
+    # Rows are loaded page by page from dokument_list_data
     context = {
-        "docs": docs,
         "doc_types": Dokumenti.TIPOVI_DOK,
-        "clients": Klijenti.objects.all(),
+        "clients": Klijenti.objects.order_by("ime").values("id", "ime"),
         "statuses": Dokumenti.FAK_STATUS,
         "sef_statuses": Dokumenti.SEF_STATUS,
         "filters": {
-            "doc_type": doc_type,
-            "client": client_id,
-            "date_from": date_from,
-            "date_to": date_to,
-            "fak_status": status_fak,
-            "sef_status": status_SEF,
+            "doc_type": params.get("doc_type"),
+            "client": params.get("client"),
+            "date_from": params.get("date_from"),
+            "date_to": params.get("date_to"),
+            "fak_status": params.get("status_fak"),
+            "sef_status": params.get("status_SEF"),
         },
         "default_date_from": default_date_from,
         "default_date_to": default_date_to,
     }
     return render(request, 'dokument_list.html', context)
 
+# DataTables column index -> ORDER BY field (column 1 and 7 aren't sortable)
+DOKUMENT_LIST_ORDER = {
+    0: "dok_br",
+    2: "klijent__ime",
+    3: "dok_datum",
+    4: "total",
+    5: "status_fak",
+    6: "status_SEF",
+}
+DOKUMENT_LIST_MAX_PAGE = 1000
+
+@require_GET
+@login_required
+def dokument_list_data(request):
+    """
+    DataTables server-side processing for dokument_list: one page of rows
+    plus the counts and the Σ of the filtered documents, all computed in SQL.
+    """
+    params = request.GET.copy()
+    if not params.get("doc_type"):
+        params["doc_type"] = "IZF"
+
+    try:
+        draw = int(params.get("draw", 0))
+        start = max(int(params.get("start", 0)), 0)
+        length = int(params.get("length", 10))
+        order_column = int(params.get("order[0][column]", 0))
+    except ValueError:
+        return JsonResponse({"error": "Neispravni parametri"}, status=400)
+    if length <= 0 or length > DOKUMENT_LIST_MAX_PAGE:
+        length = DOKUMENT_LIST_MAX_PAGE
+
+    docs = filter_dokumenti(params).annotate(total=F("iznos_P") + F("iznos_U"))
+    records_total = docs.count()
+
+    search = params.get("search[value]", "").strip()
+    if search:
+        docs = docs.filter(Q(dok_br__icontains=search) | Q(klijent__ime__icontains=search))
+    summary = docs.aggregate(count=Count("id"), sum=Sum("total"))
+
+    field = DOKUMENT_LIST_ORDER.get(order_column, "dok_br")
+    prefix = "-" if params.get("order[0][dir]") == "desc" else ""
+    rows = docs.order_by(f"{prefix}{field}", f"{prefix}id").values(
+        "id", "dok_tip", "dok_br", "klijent__ime", "dok_datum", "total",
+        "status_fak", "status_SEF", "efaktura", "invoiceId",
+        "faktura_id", "faktura__dok_br",
+    )[start:start + length]
+
+    tip_labels = dict(Dokumenti.TIPOVI_DOK)
+    fak_labels = dict(Dokumenti.FAK_STATUS)
+    sef_labels = dict(Dokumenti.SEF_STATUS)
+    data = [
+        {
+            "id": row["id"],
+            "dok_tip": row["dok_tip"],
+            "dok_tip_display": tip_labels.get(row["dok_tip"], row["dok_tip"]),
+            "dok_br": row["dok_br"],
+            "klijent": row["klijent__ime"],
+            "datum": row["dok_datum"].strftime("%d.%m.%Y") if row["dok_datum"] else "",
+            "total": float(row["total"] or 0),
+            "status_fak": row["status_fak"],
+            "status_fak_display": fak_labels.get(row["status_fak"], row["status_fak"]),
+            "status_SEF": row["status_SEF"],
+            "status_SEF_display": sef_labels.get(row["status_SEF"], row["status_SEF"]),
+            "efaktura": row["efaktura"],
+            "uploaded": bool(row["invoiceId"]),
+            "faktura_id": row["faktura_id"],
+            "faktura_br": row["faktura__dok_br"],
+        }
+        for row in rows
+    ]
+
+    return JsonResponse({
+        "draw": draw,
+        "recordsTotal": records_total,
+        "recordsFiltered": summary["count"],
+        "sum": float(summary["sum"] or 0),
+        "data": data,
+    })
+
 @login_required
 def dokument_details(request, pk):
     try:
@@ -1036,10 +1023,36 @@ def dokument_details(request, pk):
         "connected_html": connected_html,
         "items": list(items),
         "is_storno": dok.is_storno,
+        "file_url": reverse("dokument_file", args=[dok.pk]) if dok.file else None,
     }
     
     return JsonResponse(data)
     
+@login_required
+def dokument_file(request, pk):
+    """Download the attached XML/PDF, decompressed if it is stored compressed."""
+    dok = get_object_or_404(Dokumenti, pk=pk)
+    if not dok.file:
+        raise Http404("Dokument nema prilog.")
+
+    name = dok.file.name
+    compression = compression_of(name)
+    if compression:
+        name = name[:-len(COMPRESSION_SUFFIXES[compression])]
+    suffix = Path(name).suffix
+    content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+
+    def stream(f):
+        # no Content-Length: the stored size is the compressed one
+        with f:
+            yield from f.chunks()
+
+    response = StreamingHttpResponse(stream(dok.file.open("rb")), content_type=content_type)
+    response["Content-Disposition"] = content_disposition_header(
+        True, f"{dok.dok_tip}-{dok.dok_br}{suffix}"
+    )
+    return response
+
 @require_GET
 @login_required
 def klijent_info(request, pk):
@@ -1056,34 +1069,33 @@ def klijent_info(request, pk):
         data = {}
     return JsonResponse(data)
     
-@csrf_exempt
-def sef_ulazne(request):
+async def receive_sef_webhook(request, webhook_type):
     if request.method != "POST":
         return JsonResponse({"error": "POST required"}, status=405)
 
     # parse JSON payload
     try:
-        data = json.loads(request.body)
+        events = normalize_payload(json.loads(request.body))
     except json.JSONDecodeError:
         return JsonResponse({"error": "invalid json"}, status=400)
+    except ValueError as e:
+        return JsonResponse({"error": str(e)}, status=400)
 
-    # store payload or process it
-    WebhookEvent.objects.create(payload=data, type="ulazne")
-    return JsonResponse({"status": "ok"})
+    # store one row per invoice event; ack only after the batch is committed
+    try:
+        stored = await aingest_webhook_events(webhook_type, events)
+    except WebhookIngestError:
+        logger.exception("SEF webhook (%s) nije sačuvan", webhook_type)
+        return JsonResponse({"error": "storage unavailable"}, status=503)
+    return JsonResponse({"status": "ok", "stored": stored})
 
 @csrf_exempt
-def sef_izlazne(request):
-    if request.method != "POST":
-        return JsonResponse({"error": "POST required"}, status=405)
+async def sef_ulazne(request):
+    return await receive_sef_webhook(request, "ulazne")
 
-    try:
-        data = json.loads(request.body)
-    except json.JSONDecodeError:
-        return JsonResponse({"error": "invalid json"}, status=400)
-
-    # process payload or store it
-    WebhookEvent.objects.create(payload=data, type="izlazne")
-    return JsonResponse({"status": "ok"})
+@csrf_exempt
+async def sef_izlazne(request):
+    return await receive_sef_webhook(request, "izlazne")
 
 def webhook_list(request):
     status = get_sef_subscription_status()
@@ -1095,12 +1107,12 @@ def webhook_list(request):
         ulazne = list(
             WebhookEvent.objects.filter(type="ulazne")
             .order_by("-received_at")
-            .values("id", "received_at", "payload")
+            .values("id", "received_at", "payload", "status", "attempts")
         )
         izlazne = list(
             WebhookEvent.objects.filter(type="izlazne")
             .order_by("-received_at")
-            .values("id", "received_at", "payload")
+            .values("id", "received_at", "payload", "status", "attempts")
         )
         return JsonResponse({"ulazne": ulazne, "izlazne": izlazne})
 
@@ -1121,7 +1133,11 @@ def delete_webhooks(request):
 @require_POST
 @staff_member_required
 def process_webhooks_view(request):
-    call_command("process_webhooks")
+    if settings.WEBHOOK_DAEMON:
+        # the daemon picks events up on its own — don't block on SEF downloads here
+        messages.info(request, "Webhook-ovi se obrađuju u pozadini.")
+    else:
+        call_command("process_webhooks")
     return redirect("webhook_list")
 
 def invoice_pdf(request, pk):
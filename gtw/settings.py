@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/5.2/ref/settings/
 """
 
 from decouple import config, Csv
+from django.core.exceptions import ImproperlyConfigured
 import os
 from pathlib import Path
 from django.core.validators import EMPTY_VALUES
@@ -91,13 +92,64 @@ TEMPLATES = [
 
 WSGI_APPLICATION = 'gtw.wsgi.application'
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        "NAME": BASE_DIR / "db" / config("DB_NAME", default="db.sqlite3"),
-    }
+# SQLite tuning, applied to every new connection (needs Django >= 5.1).
+# WAL lets web requests keep reading while the webhook worker writes;
+# synchronous=NORMAL is durable in WAL mode except for the last commits
+# on power loss. Writers start with BEGIN IMMEDIATE: a transaction that
+# reads first and writes later can't be refused with "database is locked"
+# when it upgrades its lock — it waits up to `timeout` (busy_timeout)
+# seconds for the write lock up front instead.
+SQLITE_PRODUCTION_OPTIONS = {
+    "init_command": (
+        "PRAGMA journal_mode=WAL;"
+        "PRAGMA synchronous=NORMAL;"
+        f"PRAGMA mmap_size={config('SQLITE_MMAP_SIZE', default=256 * 1024 * 1024, cast=int)};"
+        # negative = KiB, per connection
+        f"PRAGMA cache_size=-{config('SQLITE_CACHE_KB', default=20000, cast=int)};"
+        "PRAGMA temp_store=MEMORY;"
+    ),
+    "transaction_mode": "IMMEDIATE",
+    "timeout": config("SQLITE_BUSY_TIMEOUT", default=20, cast=int),
 }
 
+# DB_ENGINE: "sqlite" (default) or "postgres" (needs psycopg[pool]).
+DB_ENGINE = config("DB_ENGINE", default="sqlite")
+
+if DB_ENGINE == "postgres":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.postgresql',
+            "NAME": config("DB_NAME", default="gtbook"),
+            "USER": config("DB_USER", default="gtbook"),
+            "PASSWORD": config("DB_PASSWORD", default=""),
+            "HOST": config("DB_HOST", default="localhost"),
+            "PORT": config("DB_PORT", default="5432"),
+            # psycopg connection pool shared by the threads of one process;
+            # max_size must cover the web threads plus the webhook workers
+            "OPTIONS": {
+                "pool": {
+                    "min_size": config("DB_POOL_MIN", default=2, cast=int),
+                    "max_size": config("DB_POOL_MAX", default=10, cast=int),
+                    "timeout": config("DB_POOL_TIMEOUT", default=10, cast=int),
+                },
+            } if config("DB_POOL", default=True, cast=bool) else {},
+        }
+    }
+elif DB_ENGINE == "sqlite":
+    DATABASES = {
+        'default': {
+            'ENGINE': 'django.db.backends.sqlite3',
+            "NAME": BASE_DIR / "db" / config("DB_NAME", default="db.sqlite3"),
+            # on in production only; SQLITE_TUNING overrides that either way
+            "OPTIONS": (
+                SQLITE_PRODUCTION_OPTIONS
+                if config("SQLITE_TUNING", default=ENV == "production", cast=bool) else {}
+            ),
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Unknown DB_ENGINE: {DB_ENGINE}")
+
 # Redirect unauthenticated users here
 LOGIN_URL = '/login/'
 LOGIN_REDIRECT_URL = '/clients/'
@@ -161,6 +213,50 @@ if SEF == "efaktura":
 else:
     SEF_API_KEY = config("DEMO_SEF_API_KEY", default="")
 
+# Logging: the webhook/XML pipeline logs key=value records under "gtbook";
+# LOG_LEVEL=DEBUG adds per-stage timings and counters.
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "formatters": {
+        "plain": {"format": "%(asctime)s %(levelname)s %(name)s %(message)s"},
+    },
+    "handlers": {
+        "console": {"class": "logging.StreamHandler", "formatter": "plain"},
+    },
+    "loggers": {
+        "gtbook": {
+            "handlers": ["console"],
+            "level": config("LOG_LEVEL", default="INFO"),
+            "propagate": False,
+        },
+    },
+}
+
+# Store new XML attachments compressed: "" (off), "gzip" or "zstd" (needs
+# the zstandard package). Existing ones: `manage.py compress_attachments`.
+ATTACHMENT_COMPRESSION = config("ATTACHMENT_COMPRESSION", default="")
+
+# True when `manage.py process_webhooks --daemon` runs alongside the web app;
+# the "process" button then leaves the work to the daemon instead of blocking.
+WEBHOOK_DAEMON = config("WEBHOOK_DAEMON", default=False, cast=bool)
+
+# WebhookLog retention: keep the newest N entries and/or drop entries older
+# than N days (0 = off). Trimming runs once every WEBHOOK_LOG_TRIM_EVERY inserts.
+WEBHOOK_LOG_MAX_ENTRIES = config("WEBHOOK_LOG_MAX_ENTRIES", default=500, cast=int)
+WEBHOOK_LOG_MAX_AGE_DAYS = config("WEBHOOK_LOG_MAX_AGE_DAYS", default=0, cast=int)
+WEBHOOK_LOG_TRIM_EVERY = config("WEBHOOK_LOG_TRIM_EVERY", default=50, cast=int)
+
+# Webhook ingestion: concurrent SEF callbacks are written together with one
+# bulk insert (max rows per insert, max extra wait in ms for more callbacks,
+# max seconds a request waits for another request's insert).
+WEBHOOK_INGEST_MAX_BATCH = config("WEBHOOK_INGEST_MAX_BATCH", default=200, cast=int)
+WEBHOOK_INGEST_WINDOW_MS = config("WEBHOOK_INGEST_WINDOW_MS", default=5, cast=int)
+WEBHOOK_INGEST_WAIT_TIMEOUT = config("WEBHOOK_INGEST_WAIT_TIMEOUT", default=10.0, cast=float)
+
+# Parallel SEF XML downloads per webhook batch (before any DB transaction).
+SEF_PREFETCH_WORKERS = config("SEF_PREFETCH_WORKERS", default=4, cast=int)
+
 #HOOKRELAY_SECRET = config('HOOKRELAY_SECRET')
 
 COMPANY = {
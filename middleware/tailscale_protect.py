@@ -1,4 +1,5 @@
 import re
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
 from django.conf import settings
 from django.http import HttpResponseForbidden
 
@@ -17,20 +18,34 @@ class TailscaleProtectMiddleware:
     ]
 
 
+    sync_capable = True
+    async_capable = True   # keeps async views (webhooks) on the event loop under ASGI
+
     def __init__(self, get_response):
         self.get_response = get_response
+        if iscoroutinefunction(self.get_response):
+            markcoroutinefunction(self)
 
     def __call__(self, request):
-        
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        return self._forbidden(request) or self.get_response(request)
+
+    async def __acall__(self, request):
+        return self._forbidden(request) or await self.get_response(request)
+
+    def _forbidden(self, request):
+        """Return the 403 response for this request, or None if it may pass."""
+
         # 1) Allow everything in DEBUG mode (local dev)
         if settings.DEBUG:
-            return self.get_response(request)
+            return None
         
         # 2) Allow explicitly public webhook paths
         path = request.path
         for pattern in self.PUBLIC_PATHS:
             if re.match(pattern, path):
-                return self.get_response(request)
+                return None
             
         # 3) Detect Tailscale-authenticated visitor
         ts_ip = request.headers.get("Tailscale-User-Derived-IP")
@@ -38,7 +53,7 @@ class TailscaleProtectMiddleware:
 
         if ts_ip or ts_user:
             # User is coming through Tailscale Tunnel or Funnel
-            return self.get_response(request)
+            return None
 
         # 4) Reject all other Internet traffic with friendly HTML page
         html_content = """